@@ -31,6 +31,15 @@ export default function Home() {
     const [latexPosition, setLatexPosition] = useState({x: 10, y: 100});
     const [isDragging, setIsDragging] = useState(false);
     const [dragOffset, setDragOffset] = useState({ x: 0, y: 0 });
+    // Lets the server remember what it already solved on this canvas, so pressing
+    // "Calculate" again only sends the newly drawn expressions to the model. Off unless
+    // VITE_INCREMENTAL_SESSIONS is "true", since reusing earlier answers can split up
+    // drawings that belong together.
+    const sessionId = useRef(
+        import.meta.env.VITE_INCREMENTAL_SESSIONS === "true"
+            ? Math.random().toString(36).slice(2) + Date.now().toString(36)
+            : undefined
+    );
 
 
     const sendData = async () => {
@@ -44,6 +53,7 @@ export default function Home() {
                     data: {
                         data: canvas.toDataURL('image/png'),
                         dict_of_vars: dictOfVars,
+                        session_id: sessionId.current,
                     },
                     headers: {
                         'Content-Type': 'application/json',
@@ -0,0 +1,131 @@
+# This file defines how a prepared drawing is turned into answers, and lets several ways
+# of doing that be combined.
+#
+# An `Analyzer` takes a prepared image (see `preprocess.py`) and the user's variables and
+# returns the answer dicts, or `None` to decline: "I'm not sure, ask someone else". There
+# are two backends:
+#
+# - `GroqAnalyzer` (in `utils.py`, next to the upstream client) sends the drawing to the
+#   vision model. It handles everything, including word problems and abstract drawings,
+#   but every call is a network round trip and costs tokens.
+# - `LocalAnalyzer` reads the drawing with the CPU-only handwriting recognizer
+#   (`recognizer.py`) and solves the text with the local solver (`solver.py`). It answers
+#   simple written math in a few milliseconds, with no network, and declines anything it
+#   can't read confidently or can't solve.
+#
+# An `AnalyzerChain` asks its analyzers in order and returns the first answer. The
+# `ANALYZER` setting picks the chain: "groq", "local", or "auto" (local first, then Groq
+# for whatever it declines).
+
+import logging
+from abc import ABC, abstractmethod
+
+from metrics import Counter, span
+from .recognizer import recognize_once
+from .solver import UnsupportedExpression, solve_text
+
+logger = logging.getLogger(__name__)
+
+ANALYZER_ANSWERS = Counter(
+    "calc_analyzer_answers_total", "Drawings answered, by analyzer.", labels=("analyzer",)
+)
+ANALYZER_DECLINES = Counter(
+    "calc_analyzer_declines_total", "Drawings an analyzer passed on to the next one, by analyzer.", labels=("analyzer",)
+)
+
+
+class Analyzer(ABC):
+    """A way of solving a prepared drawing. Subclasses implement `analyze`."""
+
+    # Shown in metrics and logs.
+    name = ""
+    # Whether the analyzer calls Groq (and so can raise `UpstreamBusy`).
+    remote = False
+
+    @abstractmethod
+    async def analyze(self, prepared, dict_of_vars: dict, mode: str):
+        """Returns the answer dicts for `prepared`, or `None` to decline."""
+
+
+class LocalAnalyzer(Analyzer):
+    """
+    Reads the drawing with `recognizer.recognize_once` and solves it with `solver.solve_text`.
+    Declines when any symbol's confidence is below `min_confidence`.
+    """
+
+    name = "local"
+
+    def __init__(self, run_in_executor, min_confidence: float):
+        # `run_in_executor(func, *args)` runs the CPU-bound recognition off the event loop.
+        self.run_in_executor = run_in_executor
+        self.min_confidence = min_confidence
+
+    async def analyze(self, prepared, dict_of_vars: dict, mode: str):
+        try:
+            recognized = await self.run_in_executor(self._recognize, prepared)
+        except Exception:
+            # A drawing that trips up the recognizer can still be read by the next analyzer.
+            logger.warning("Local recognizer failed", exc_info=True)
+            return None
+        if recognized is None:
+            return None
+        text, confidence = recognized
+        if confidence < self.min_confidence:
+            logger.debug("Local recognizer unsure (%.2f): %r", confidence, text)
+            return None
+        try:
+            return solve_text(text, dict_of_vars)
+        except UnsupportedExpression as e:
+            logger.debug("Local solver declined %r: %s", text, e)
+            return None
+        except Exception:
+            # Any other solver failure is a drawing this backend can't finish; the next
+            # analyzer still gets it, rather than the user getting an error.
+            logger.warning("Local solver failed on %r", text, exc_info=True)
+            return None
+
+    @staticmethod
+    def _recognize(prepared):
+        with span("recognize"):
+            return recognize_once(prepared)
+
+
+class AnalyzerChain:
+    """Asks each analyzer in turn; the first one that doesn't decline answers."""
+
+    def __init__(self, analyzers: list):
+        self.analyzers = analyzers
+
+    @property
+    def remote(self) -> bool:
+        """Whether any analyzer in the chain calls Groq."""
+        return any(analyzer.remote for analyzer in self.analyzers)
+
+    @property
+    def local(self) -> bool:
+        """Whether any analyzer in the chain runs on this machine."""
+        return any(not analyzer.remote for analyzer in self.analyzers)
+
+    async def analyze(self, prepared, dict_of_vars: dict, mode: str, remote: bool = True):
+        """
+        Returns the first answer, or `None` when every analyzer declined. With
+        `remote=False` only the local analyzers are asked.
+        """
+        for analyzer in self.analyzers:
+            if analyzer.remote and not remote:
+                continue
+            answers = await analyzer.analyze(prepared, dict_of_vars, mode)
+            if answers is not None:
+                ANALYZER_ANSWERS.inc(analyzer=analyzer.name)
+                return answers
+            ANALYZER_DECLINES.inc(analyzer=analyzer.name)
+        return None
+
+
+def build_analyzer(name: str, groq: Analyzer, local: Analyzer) -> AnalyzerChain:
+    """The chain for the `ANALYZER` setting: "groq", "local" or "auto"."""
+    name = (name or "groq").lower()
+    chains = {"groq": [groq], "local": [local], "auto": [local, groq]}
+    if name not in chains:
+        raise ValueError(f"Unknown ANALYZER: {name!r}")
+    return AnalyzerChain(chains[name])
@@ -0,0 +1,293 @@
+# This file implements the result cache that sits in front of the Groq call.
+#
+# Users often press "Calculate" several times on the same drawing. Each of those presses
+# would otherwise pay a full vision-model round trip and count against our rate limit.
+# Instead, we hash the normalized image bytes together with a canonical form of
+# `dict_of_vars` and remember the parsed answer under that key.
+#
+# Two storage backends are available:
+# - `MemoryBackend`: an in-process LRU dictionary. Fastest, but private to one worker.
+# - `SQLiteBackend`: a small SQLite file on local disk. Every uvicorn worker on the machine
+#   opens the same file, so a hit recorded by one worker is visible to all of them.
+#
+# SQLite calls do file I/O and can wait on another worker's write lock, so callers run
+# them off the event loop (see `blocking` and `utils.run_in_store_executor`). Each write
+# is kept cheap: the total size and entry count are maintained by triggers instead of
+# being summed over the whole table, and cache hits update their recency in batches
+# rather than with one write each.
+#
+# Both backends store the answer as a JSON string. Decoding it on every hit hands the
+# caller a fresh list of dicts, so the route can mutate the result without corrupting
+# the cached copy.
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) an SQLite call waits for another worker's write lock before the
+# cache gives up: a lookup counts as a miss and a write is skipped.
+SQLITE_BUSY_TIMEOUT = 0.5
+
+# Cache hits record their access time in memory and write it out once this many are
+# pending, or this many seconds after the last write, whichever comes first.
+TOUCH_BATCH = 64
+TOUCH_INTERVAL = 1.0
+
+
+def cache_key(image_bytes: bytes, dict_of_vars: dict) -> str:
+    # `sort_keys` and fixed separators make the serialization canonical: the same
+    # variables in a different order produce the same key.
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b"\0")
+    digest.update(json.dumps(dict_of_vars, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU store with a byte budget and per-entry expiry."""
+
+    # Every call returns in microseconds, so it can run on the event loop.
+    blocking = False
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            # Mark as most recently used.
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self.size_bytes += size
+            # Evict least recently used entries until we're back under budget.
+            while self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key: str):
+        expires_at, value = self._entries.pop(key)
+        self.size_bytes -= len(value)
+
+
+class SQLiteBackend:
+    """LRU store in a SQLite file shared by every worker process on the host."""
+
+    # Calls do file I/O and may wait for a lock; run them off the event loop.
+    blocking = True
+
+    def __init__(self, path: str, max_bytes: int, ttl: float, table: str = "results"):
+        # `table` lets several stores share one file; it comes from code, never from input.
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.table = table
+        self._local = threading.local()
+        self._touched = {}  # key -> accessed_at, not yet written
+        self._touched_at = time.monotonic()
+        self._touch_lock = threading.Lock()
+        conn = self._connect()
+        # Every worker runs this at startup; the write lock makes sure the totals are
+        # counted once, together with the triggers that keep them up to date.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed_at)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table} (expires_at)")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table}_totals ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " size INTEGER NOT NULL,"
+                " entries INTEGER NOT NULL)"
+            )
+            conn.execute(
+                f"INSERT OR IGNORE INTO {table}_totals (id, size, entries)"
+                f" SELECT 0, COALESCE(SUM(size), 0), COUNT(*) FROM {table}"
+            )
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_added AFTER INSERT ON {table} BEGIN"
+                f" UPDATE {table}_totals SET size = size + NEW.size, entries = entries + 1; END"
+            )
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_removed AFTER DELETE ON {table} BEGIN"
+                f" UPDATE {table}_totals SET size = size - OLD.size, entries = entries - 1; END"
+            )
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_resized AFTER UPDATE OF size ON {table} BEGIN"
+                f" UPDATE {table}_totals SET size = size - OLD.size + NEW.size; END"
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads, so each thread that
+        # touches the cache gets its own. WAL mode lets readers in other workers
+        # proceed while one worker writes.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        # Wall-clock time (not monotonic) because the timestamps are compared across processes.
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            self._touch(conn, key, now)
+        except sqlite3.OperationalError as e:
+            # Typically "database is locked": treat it as a miss rather than wait longer.
+            logger.warning("Skipped %s lookup: %s", self.table, e)
+            return None
+        return value
+
+    def set(self, key: str, value: str):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_touches(conn, self._take_touches())
+                conn.execute(
+                    f"INSERT INTO {self.table} (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size,"
+                    " expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                    (key, value, size, now + self.ttl, now),
+                )
+                conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,))
+                total = conn.execute(f"SELECT size FROM {self.table}_totals").fetchone()[0]
+                if total > self.max_bytes:
+                    # Walk entries from least to most recently used and drop them until
+                    # the remaining total fits within the budget.
+                    excess = total - self.max_bytes
+                    victims = []
+                    for victim_key, victim_size in conn.execute(
+                        f"SELECT key, size FROM {self.table} ORDER BY accessed_at ASC"
+                    ):
+                        if excess <= 0:
+                            break
+                        victims.append((victim_key,))
+                        excess -= victim_size
+                    conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", victims)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as e:
+            logger.warning("Skipped %s write: %s", self.table, e)
+
+    def _touch(self, conn: sqlite3.Connection, key: str, now: float):
+        # Recency only decides which entries are evicted first, so it can lag behind a
+        # little; writing it once per batch keeps hits from contending for the write lock.
+        with self._touch_lock:
+            self._touched[key] = now
+            due = len(self._touched) >= TOUCH_BATCH or time.monotonic() - self._touched_at >= TOUCH_INTERVAL
+        if not due:
+            return
+        touched = self._take_touches()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # Another worker is writing; these hits just don't refresh their entries.
+            return
+        try:
+            self._write_touches(conn, touched)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _take_touches(self) -> dict:
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.monotonic()
+        return touched
+
+    def _write_touches(self, conn: sqlite3.Connection, touched: dict):
+        conn.executemany(
+            f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in touched.items()],
+        )
+
+    def __len__(self):
+        return self._connect().execute(f"SELECT entries FROM {self.table}_totals").fetchone()[0]
+
+
+class ResultCache:
+    """Front end for a cache backend that also counts hits and misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, answers: list):
+        self.backend.set(key, json.dumps(answers, default=str))
+
+
+def build_result_cache(backend: str, max_bytes: int, ttl: float, path: str):
+    # `backend` comes straight from configuration. "off" (or an empty value)
+    # disables caching entirely; callers check for `None`.
+    backend = (backend or "off").lower()
+    if backend == "memory":
+        return ResultCache(MemoryBackend(max_bytes, ttl))
+    if backend == "sqlite":
+        return ResultCache(SQLiteBackend(path, max_bytes, ttl))
+    if backend == "off":
+        return None
+    raise ValueError(f"Unknown RESULT_CACHE_BACKEND: {backend!r}")
@@ -0,0 +1,398 @@
+# This file is the single way out to the Groq API: every chat completion goes through
+# the `UpstreamGateway` below, which decides when a call may be made, which model it
+# goes to, and what happens when it fails.
+#
+# - Rate limits: Groq reports the remaining requests and tokens, and when they reset, in
+#   `x-ratelimit-*` headers on every response. Two token buckets (`RateBucket`) track
+#   those budgets between responses. A call first reserves its share and waits until
+#   the bucket can cover it, instead of being sent and bouncing off a 429. The budget is
+#   the account's, shared by every worker, so each worker only counts its own share of it
+#   (like `GROQ_WORKER_CONCURRENCY`).
+# - Concurrency and priority: once its budget is covered, a call takes a slot from the
+#   `UpstreamLimiter`. Throttled calls wait before that, so they don't hold slots.
+# - Retries: rate limits (429), timeouts, connection errors and 5xx responses are retried
+#   with jittered exponential backoff, honoring `retry-after`. Retries draw from a
+#   worker-wide `RetryBudget`, so during an outage the retries can't multiply the load.
+# - Circuit breaker: after several consecutive failed calls to a model, its
+#   `CircuitBreaker` opens and calls fail fast (or go to the fallback model) until a
+#   trial call succeeds again.
+#
+# The Groq SDK's own retries are turned off, since they would happen inside a slot and
+# outside of the budget.
+
+import asyncio
+import logging
+import random
+import re
+import time
+
+import groq
+
+from metrics import Counter, Gauge, span
+from .limiter import PRIORITY_INTERACTIVE, UpstreamBusy
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_RETRIES = Counter(
+    "calc_upstream_retries_total", "Upstream calls retried, by reason.", labels=("reason",)
+)
+UPSTREAM_FAILURES = Counter(
+    "calc_upstream_failures_total", "Upstream calls that failed after any retries, by reason.", labels=("reason",)
+)
+CIRCUIT_OPEN = Gauge(
+    "calc_upstream_circuit_open", "1 while the circuit breaker for a model is open.", labels=("model",)
+)
+RATE_LIMIT_WAITS = Counter(
+    "calc_rate_limit_wait_seconds_total", "Time spent waiting for the provider's rate limit budget."
+)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class UpstreamUnavailable(UpstreamBusy):
+    """Raised while the circuit breaker is open and no fallback model is available."""
+
+
+def parse_duration(value: str):
+    """Parses Groq's reset durations ("7.66s", "2m59.56s", "120ms"). Returns seconds or `None`."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+class RateBucket:
+    """
+    A token bucket that is re-synchronized from the provider's headers.
+
+    Until the first response it knows nothing and never delays a call. After that, the
+    level is the provider's "remaining" value, minus what calls still in flight have
+    reserved (the provider hasn't counted those yet), and it refills at the rate needed to
+    reach the limit by the reported reset time.
+
+    The headers describe the whole account. With several workers each one sees the same
+    "remaining" value but only knows about its own calls, so each bucket uses `share` of
+    the reported limit, remaining budget and refill rate.
+    """
+
+    def __init__(self, name: str, share: float = 1.0):
+        self.name = name
+        self.share = share
+        self.capacity = None
+        self.level = 0.0
+        self.rate = 0.0
+        self.outstanding = 0.0
+        self._updated = time.monotonic()
+
+    def update(self, limit, remaining, reset_seconds):
+        if limit is None or remaining is None:
+            return
+        limit, remaining = limit * self.share, remaining * self.share
+        self.capacity = limit
+        self.level = remaining - self.outstanding
+        refill = limit - remaining
+        self.rate = refill / reset_seconds if reset_seconds else limit / 60
+        self._updated = time.monotonic()
+
+    def reserve(self, cost: float) -> float:
+        """Takes `cost` from the bucket. Returns how long to wait before it is covered."""
+        self.outstanding += cost
+        if self.capacity is None:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+        # Later callers queue up behind earlier reservations, since the level goes negative.
+        self.level -= cost
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate if self.rate > 0 else float("inf")
+
+    def settle(self, cost: float):
+        """Called when the call that reserved `cost` has completed (or failed)."""
+        self.outstanding = max(self.outstanding - cost, 0.0)
+
+    def refund(self, cost: float):
+        """Gives back a reservation that was never used."""
+        self.settle(cost)
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + cost)
+
+
+class Reservation:
+    """
+    One call's share of the rate limit buckets. It is settled once the call reaches the
+    provider, or refunded if the call is never sent (rejected, or cancelled while it
+    waited). Whichever happens first wins; the other is then a no-op.
+    """
+
+    def __init__(self, buckets: dict):
+        # Maps each `RateBucket` to the amount reserved from it.
+        self.buckets = buckets
+
+    def settle(self):
+        for bucket, cost in self.buckets.items():
+            bucket.settle(cost)
+        self.buckets = {}
+
+    def refund(self):
+        for bucket, cost in self.buckets.items():
+            bucket.refund(cost)
+        self.buckets = {}
+
+
+class RetryBudget:
+    """
+    Allows retries up to `ratio` of the calls made.
+
+    Every call deposits `ratio` and every retry withdraws 1, so with a ratio of 0.2 at most
+    one call in five is retried. The balance starts at, and never exceeds, `reserve`: a
+    quiet period saves up a few retries for a short burst of errors, but not more.
+    """
+
+    def __init__(self, ratio: float, reserve: float):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = reserve
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, self.reserve)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; lets one trial call through after `cooldown`."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        # A trial call that never reported back (it was cancelled) doesn't block the
+        # next one forever.
+        now = time.monotonic()
+        if state == "half_open" and (self._trial_at is None or now - self._trial_at >= self.cooldown):
+            self._trial_at = now
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def failure(self):
+        self.failures += 1
+        self._trial_at = None
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+
+def _header_number(headers, name: str):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _retry_reason(error: Exception):
+    """Returns a short reason if `error` is worth retrying, otherwise `None`."""
+    if isinstance(error, groq.APITimeoutError):
+        return "timeout"
+    if isinstance(error, groq.APIConnectionError):
+        return "connection"
+    if isinstance(error, groq.APIStatusError):
+        if error.status_code == 429:
+            return "rate_limit"
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return f"status_{error.status_code}"
+    return None
+
+
+class UpstreamGateway:
+    def __init__(
+        self, limiter, client_factory, *, max_retries: int, retry_budget: RetryBudget,
+        base_delay: float, max_delay: float, max_rate_wait: float,
+        breaker_threshold: int, breaker_cooldown: float, fallback_model: str = "",
+        rate_share: float = 1.0,
+    ):
+        self.limiter = limiter
+        self.client_factory = client_factory
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_rate_wait = max_rate_wait
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.fallback_model = fallback_model
+        self.requests = RateBucket("requests", rate_share)
+        self.tokens = RateBucket("tokens", rate_share)
+        self.breakers = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return self.breakers[model]
+
+    def _outcome(self, model: str, ok: bool):
+        breaker = self.breaker(model)
+        if ok:
+            breaker.success()
+        else:
+            breaker.failure()
+        CIRCUIT_OPEN.set(int(breaker.opened_at is not None), model=model)
+
+    def _route(self, model: str) -> str:
+        if self.breaker(model).allow():
+            return model
+        if self.fallback_model and self.fallback_model != model and self.breaker(self.fallback_model).allow():
+            logger.info("Circuit for %s is open; using %s", model, self.fallback_model)
+            return self.fallback_model
+        raise UpstreamUnavailable(f"Upstream model {model} is unavailable, try again shortly")
+
+    async def _reserve(self, estimated_tokens: int) -> Reservation:
+        """Reserves one call's budget, waiting until the buckets can cover it."""
+        reservation = Reservation({self.requests: 1, self.tokens: estimated_tokens})
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait > self.max_rate_wait:
+            reservation.refund()
+            raise UpstreamBusy(f"Upstream rate limit reached; budget frees up in {wait:.0f}s")
+        if wait > 0:
+            RATE_LIMIT_WAITS.inc(wait)
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                # Usually a cancellation: the client went away, or single-flight dropped
+                # the call. Left reserved, the budget would be lost for good.
+                reservation.refund()
+                raise
+        return reservation
+
+    async def _call(self, reservation: Reservation, **kwargs):
+        """Makes one upstream call with a reserved budget. Returns `(raw_response, parsed)`."""
+        try:
+            raw = await self.client_factory().chat.completions.with_raw_response.create(**kwargs)
+            return raw, await raw.parse()
+        finally:
+            reservation.settle()
+
+    def _observe_headers(self, headers):
+        if headers is None:
+            return
+        self.requests.update(
+            _header_number(headers, "x-ratelimit-limit-requests"),
+            _header_number(headers, "x-ratelimit-remaining-requests"),
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+        )
+        self.tokens.update(
+            _header_number(headers, "x-ratelimit-limit-tokens"),
+            _header_number(headers, "x-ratelimit-remaining-tokens"),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        )
+
+    def _backoff(self, error: Exception, attempt: int, model: str) -> float:
+        """Returns how long to wait before retrying `error`, or re-raises it."""
+        if isinstance(error, UpstreamBusy):
+            raise error
+        response = getattr(error, "response", None)
+        self._observe_headers(getattr(response, "headers", None))
+        reason = _retry_reason(error)
+        # A rate limit or a rejected request still means the model is up.
+        self._outcome(model, reason is None or reason == "rate_limit")
+        if reason is None or attempt >= self.max_retries or not self.retry_budget.withdraw():
+            UPSTREAM_FAILURES.inc(reason=reason or type(error).__name__)
+            # Still rate limited after retrying: the client should come back later (503),
+            # rather than get the error as its answer.
+            if reason == "rate_limit":
+                raise UpstreamBusy("Upstream rate limit reached, try again shortly") from error
+            raise error
+        retry_after = parse_duration(response.headers.get("retry-after")) if response is not None else None
+        if retry_after and retry_after > self.max_rate_wait:
+            UPSTREAM_FAILURES.inc(reason=reason)
+            raise UpstreamBusy(f"Upstream asked us to retry in {retry_after:.0f}s") from error
+        UPSTREAM_RETRIES.inc(reason=reason)
+        # "Full jitter": a random delay up to the exponential bound spreads retries out.
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def create(self, model: str, estimated_tokens: int, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """Makes a (non-streaming) chat completion call. Returns `(completion, model_used)`."""
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            routed = self._route(model)
+            reservation = await self._reserve(estimated_tokens)
+            try:
+                async with self.limiter.slot(priority):
+                    try:
+                        with span("upstream"):
+                            raw, completion = await self._call(reservation, model=routed, **kwargs)
+                    except Exception as e:
+                        delay = self._backoff(e, attempt, routed)
+                    else:
+                        self._observe_headers(raw.headers)
+                        self._outcome(routed, True)
+                        return completion, routed
+            finally:
+                # Rejected or cancelled while queued for a slot: the call was never sent.
+                reservation.refund()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, model: str, estimated_tokens: int, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Streaming variant of `create`; yields the chunks. Only opening the stream is
+        retried: once chunks have been passed on, an error is raised to the caller.
+        """
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            routed = self._route(model)
+            reservation = await self._reserve(estimated_tokens)
+            try:
+                async with self.limiter.slot(priority):
+                    with span("upstream"):
+                        try:
+                            raw, stream = await self._call(reservation, model=routed, stream=True, **kwargs)
+                        except Exception as e:
+                            delay = self._backoff(e, attempt, routed)
+                        else:
+                            self._observe_headers(raw.headers)
+                            self._outcome(routed, True)
+                            # If the caller goes away mid-stream, this generator is closed and the
+                            # `finally` releases the upstream connection (and the limiter slot).
+                            try:
+                                async for chunk in stream:
+                                    yield chunk
+                            finally:
+                                await stream.close()
+                            return
+            finally:
+                reservation.refund()
+            attempt += 1
+            await asyncio.sleep(delay)
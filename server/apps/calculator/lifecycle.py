@@ -0,0 +1,149 @@
+# This file prepares a worker to serve requests, and reports whether it is able to.
+#
+# Without any preparation, the first requests a new worker handles are its slowest: the
+# TLS connections to Groq have to be set up, PIL loads its image plugins and NumPy and
+# the image threads start on demand. `startup()` does all of that before the worker is
+# reported as ready:
+#
+# - It opens `UPSTREAM_PREWARM_CONNECTIONS` connections to Groq with a few concurrent,
+#   free "list models" calls. They stay in the client's pool for later requests.
+# - It encodes and decodes a small drawing in every format the pipeline uses, on every
+#   image thread, so codecs are loaded and the threads exist.
+# - It builds the handwriting recognizer's glyph model, which the local analyzer and
+#   model routing use. With `ANALYZER=local` nothing calls Groq, so no connections are
+#   opened.
+#
+# `readiness()` is what `GET /readyz` reports: whether startup has finished and how full
+# the upstream slots and the queue behind them are. A load balancer can stop sending
+# requests to a worker whose queue is full instead of having them rejected with a 503.
+#
+# `metrics_text()` is what `GET /metrics` reports. With `METRICS_PATH` set (the default
+# with several workers), every worker publishes its metrics there in the background and
+# the scrape shows all of them, not just the worker that happened to answer it.
+
+import asyncio
+import logging
+import sqlite3
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from constants import (
+    IMAGE_WORKERS, PREPROCESS_MAX_DIM, PREPROCESS_PADDING, UPSTREAM_PREWARM_CONNECTIONS,
+    METRICS_PATH, METRICS_PUBLISH_INTERVAL,
+)
+from metrics import SharedMetrics, render_metrics
+from .preprocess import encode_prepared, prepare_image
+from .recognizer import get_model
+from .utils import analyzer, image_executor, limiter, run_in_image_executor, store_executor, upstream_client
+
+# How long each pre-warming call may take before startup carries on without it.
+PREWARM_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+state = {"ready": False, "warm_connections": 0}
+
+# A worker that hasn't published for a few intervals has exited (or is stuck), so its
+# gauges no longer describe anything.
+shared_metrics = SharedMetrics(METRICS_PATH, stale_after=3 * METRICS_PUBLISH_INTERVAL) if METRICS_PATH else None
+_publisher = None
+
+
+def preload_codecs():
+    img = Image.new("RGBA", (96, 64), (0, 0, 0, 0))
+    ImageDraw.Draw(img).line([(10, 10), (80, 50)], fill=(255, 255, 255, 255), width=5)
+    for fmt in ("PNG", "WEBP", "JPEG"):
+        buffered = BytesIO()
+        (img.convert("RGB") if fmt == "JPEG" else img).save(buffered, format=fmt)
+        Image.open(BytesIO(buffered.getvalue())).load()
+    encode_prepared(prepare_image(img, PREPROCESS_MAX_DIM, PREPROCESS_PADDING))
+
+
+async def prewarm_upstream(count: int) -> int:
+    """Opens up to `count` pooled connections to Groq. Returns how many succeeded."""
+    if count <= 0:
+        return 0
+    client = upstream_client().with_options(max_retries=0, timeout=PREWARM_TIMEOUT)
+    # The calls run concurrently, so each one needs a connection of its own.
+    results = await asyncio.gather(*(client.models.list() for _ in range(count)), return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        logger.warning("Could not pre-warm %d upstream connections: %s", len(failures), failures[0])
+    return count - len(failures)
+
+
+async def publish_metrics():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            await loop.run_in_executor(store_executor, shared_metrics.publish)
+        except sqlite3.Error as e:
+            logger.warning("Could not publish metrics: %s", e)
+
+
+async def metrics_text() -> str:
+    """The Prometheus text for `GET /metrics`: every worker's metrics, or just this one's."""
+    if shared_metrics is None:
+        return render_metrics()
+    loop = asyncio.get_running_loop()
+    try:
+        workers = await loop.run_in_executor(store_executor, shared_metrics.collect)
+    except sqlite3.Error as e:
+        logger.warning("Could not read other workers' metrics: %s", e)
+        return render_metrics()
+    return render_metrics(workers)
+
+
+async def startup():
+    global _publisher
+    start = time.perf_counter()
+    connections = min(UPSTREAM_PREWARM_CONNECTIONS, limiter.max_concurrency) if analyzer.remote else 0
+    upstream = asyncio.create_task(prewarm_upstream(connections))
+    # One job per image thread makes the pool start all of them.
+    jobs = [run_in_image_executor(preload_codecs) for _ in range(IMAGE_WORKERS)]
+    jobs.append(run_in_image_executor(get_model))
+    await asyncio.gather(*jobs)
+    state["warm_connections"] = await upstream
+    if shared_metrics is not None:
+        _publisher = asyncio.create_task(publish_metrics())
+    state["ready"] = True
+    logger.info(
+        "Worker ready in %.2fs (%d upstream connections warm)",
+        time.perf_counter() - start, state["warm_connections"],
+    )
+
+
+async def shutdown():
+    state["ready"] = False
+    await upstream_client().close()
+    image_executor.shutdown(wait=False, cancel_futures=True)
+    if _publisher is not None:
+        _publisher.cancel()
+        # The final counts, so they are still included after this worker is gone.
+        try:
+            await asyncio.get_running_loop().run_in_executor(store_executor, shared_metrics.publish)
+        except sqlite3.Error as e:
+            logger.warning("Could not publish metrics: %s", e)
+    # Pending cache writes are cheap; let them finish so they aren't lost.
+    store_executor.shutdown(wait=True)
+
+
+def readiness():
+    """Returns `(ready, details)` for the readiness probe."""
+    capacity = limiter.max_concurrency + limiter.max_queue
+    details = {
+        "ready": state["ready"],
+        "warm_connections": state["warm_connections"],
+        "upstream": {
+            "in_flight": limiter.in_flight,
+            "waiting": limiter.waiting,
+            "max_concurrency": limiter.max_concurrency,
+            "max_queue": limiter.max_queue,
+            "saturation": round((limiter.in_flight + limiter.waiting) / capacity, 3),
+        },
+    }
+    # A full queue means new requests would be rejected right away.
+    return state["ready"] and limiter.waiting < limiter.max_queue, details
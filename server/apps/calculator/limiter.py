@@ -0,0 +1,76 @@
+# This file caps how much upstream (Groq) work a single worker process does at once.
+#
+# Every `/calculate` request eventually waits on a slow network call to the vision model.
+# Without a cap, a burst of users opens as many concurrent upstream calls as there are
+# requests, which runs straight into the provider's rate limits and lets the waiting work
+# grow without bound. The `UpstreamLimiter` below allows a fixed number of calls to run
+# and a bounded number to queue behind them; anything past that is rejected immediately
+# so the client gets a fast "try again" instead of a request that hangs for minutes.
+#
+# Waiting requests are served by priority, then in arrival order: a user waiting for a
+# single drawing (`PRIORITY_INTERACTIVE`) goes ahead of the images of a batch request
+# (`PRIORITY_BATCH`) that were queued earlier.
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+
+# Lower numbers are served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class UpstreamBusy(Exception):
+    """Raised when both the in-flight slots and the wait queue are full."""
+
+
+class UpstreamLimiter:
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._free = max_concurrency
+        self._waiters = []  # heap of (priority, arrival, future)
+        self._arrival = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        if self._free > 0 and not self.waiting:
+            self._free -= 1
+        else:
+            # Every slot is taken. If the queue is already at its limit, we refuse the
+            # request up front.
+            if self.waiting >= self.max_queue:
+                raise UpstreamBusy(
+                    f"Upstream queue is full ({self.in_flight} in flight, {self.waiting} waiting)"
+                )
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._arrival), future))
+            self.waiting += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                # If the slot was handed over just as we were cancelled, pass it on.
+                # Otherwise the cancelled future stays in the heap and is skipped.
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+            finally:
+                self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._release()
+
+    def _release(self):
+        # Hand the slot straight to the most urgent waiter, or return it to the pool.
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
@@ -0,0 +1,234 @@
+# This file turns the vision model's raw text answer into a list of result dicts.
+#
+# We ask the model for a Python-style list of dicts, but what comes back varies: sometimes
+# valid JSON, sometimes a Python literal, sometimes wrapped in prose or markdown fences,
+# with unquoted keys, a missing comma, an apostrophe inside a single-quoted string, LaTeX
+# like "\frac{1}{2}" whose backslashes aren't escaped, or cut off half-way when the token
+# limit is reached.
+#
+# Instead of trying one strict parser after another, `parse_answers` reads the text once,
+# left to right, with a small recursive-descent parser that accepts all of those forms.
+# Everything it had to repair is recorded as a diagnostic, so we can measure how often the
+# model's output is malformed (see `bench/bench_parser.py`).
+
+import re
+
+# Where the answer starts: a list whose first element is a dict, or failing that a lone dict.
+_START = re.compile(r"\[\s*\{|\{")
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_LITERALS = {"true": True, "false": False, "none": None, "null": None}
+_STRING_SPECIAL = {"'": re.compile(r"[\\']"), '"': re.compile(r'[\\"]')}
+_ESCAPES = {"\\": "\\", "'": "'", '"': '"', "/": "/"}
+
+
+class ParseResult:
+    """The outcome of parsing one response."""
+
+    def __init__(self, answers: list, diagnostics: list):
+        # The result dicts found, each with at least 'expr', 'result' and 'assign'.
+        self.answers = answers
+        # `(position, message)` pairs describing everything that had to be repaired.
+        self.diagnostics = diagnostics
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.answers)
+
+    @property
+    def clean(self) -> bool:
+        """True when the response was well formed and needed no repairs."""
+        return bool(self.answers) and not self.diagnostics
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.diagnostics = []
+
+    def note(self, message: str, pos: int = None):
+        self.diagnostics.append((self.pos if pos is None else pos, message))
+
+    def skip_space(self):
+        text, pos = self.text, self.pos
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        self.pos = pos
+
+    def peek(self):
+        self.skip_space()
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+
+    def value(self, stop: str):
+        char = self.peek()
+        if char == "{":
+            return self.dict()
+        if char == "[":
+            return self.list()
+        if char in ("'", '"'):
+            return self.string(stop)
+        return self.bare(stop)
+
+    def dict(self):
+        self.pos += 1  # "{"
+        out = {}
+        while True:
+            char = self.peek()
+            if char == "}":
+                self.pos += 1
+                return out
+            if char == "":
+                self.note("Input ended inside a dict")
+                return out
+            if char == ",":
+                self.note("Unexpected ','")
+                self.pos += 1
+                continue
+
+            key = self.string(":") if char in ("'", '"') else self.bare(":,}")
+            if not isinstance(key, str):
+                key = str(key)
+            if self.peek() == ":":
+                self.pos += 1
+            else:
+                self.note(f"Missing ':' after key {key!r}")
+            out[key] = self.value(",}")
+
+            char = self.peek()
+            if char == ",":
+                self.pos += 1
+            elif char not in ("}", ""):
+                self.note("Missing ',' between dict entries")
+
+    def list(self):
+        self.pos += 1  # "["
+        out = []
+        while True:
+            char = self.peek()
+            if char == "]":
+                self.pos += 1
+                return out
+            if char == "":
+                self.note("Input ended inside a list")
+                return out
+            if char == ",":
+                self.note("Unexpected ','")
+                self.pos += 1
+                continue
+            out.append(self.value(",]"))
+            char = self.peek()
+            if char == ",":
+                self.pos += 1
+            elif char not in ("]", ""):
+                self.note("Missing ',' between list items")
+
+    def string(self, stop: str):
+        text = self.text
+        quote = text[self.pos]
+        start = self.pos
+        self.pos += 1
+        pieces = []
+        special = _STRING_SPECIAL[quote]
+        while True:
+            # Copy plain characters in one slice, up to the next backslash or quote.
+            match = special.search(text, self.pos)
+            if match is None:
+                pieces.append(text[self.pos:])
+                self.pos = len(text)
+                break
+            pieces.append(text[self.pos:match.start()])
+            self.pos = match.start()
+            char = text[self.pos]
+            if char == "\\" and self.pos + 1 < len(text):
+                following = text[self.pos + 1]
+                if following in _ESCAPES:
+                    pieces.append(_ESCAPES[following])
+                    self.pos += 2
+                    continue
+                if following == "n" and not text[self.pos + 2:self.pos + 3].isalpha():
+                    pieces.append("\n")
+                    self.pos += 2
+                    continue
+                # Anything else is LaTeX ("\frac", "\sqrt", "\times"): keep the backslash.
+                pieces.append(char)
+                self.pos += 1
+                continue
+            if char == quote:
+                # Only treat the quote as closing the string if what follows could come
+                # after a string (including the next quoted key, when a comma is missing).
+                # Otherwise it's an apostrophe, as in 'it's love'.
+                after = self.pos + 1
+                while after < len(text) and text[after] in " \t":
+                    after += 1
+                if after >= len(text) or text[after] in stop or text[after] in ",:}]\r\n'\"":
+                    self.pos += 1
+                    return "".join(pieces)
+                self.note("Unescaped quote inside a string")
+            pieces.append(char)
+            self.pos += 1
+        self.note("Unterminated string", start)
+        return "".join(pieces)
+
+    def bare(self, stop: str):
+        # An unquoted token: a number, true/false/none, or a word the model forgot to quote.
+        text = self.text
+        start = self.pos
+        end = start
+        while end < len(text) and text[end] not in stop and text[end] not in "{}[]":
+            end += 1
+        token = text[start:end].strip()
+        self.pos = end
+        if not token:
+            self.note("Missing value")
+            # A stray bracket that doesn't belong here: skip it so the caller always
+            # makes progress.
+            if end < len(text) and text[end] not in stop:
+                self.pos = end + 1
+            return None
+        if _NUMBER.fullmatch(token):
+            return float(token) if any(c in token for c in ".eE") else int(token)
+        if token.lower() in _LITERALS:
+            return _LITERALS[token.lower()]
+        if len(token) > 1 and token[0] == token[-1] and token[0] in "'\"":
+            return token[1:-1]
+        self.note(f"Unquoted token {token!r}", start)
+        return token
+
+
+def _to_answer(value):
+    # Coerce one parsed dict into the shape the API returns.
+    answer = {str(key).strip(): item for key, item in value.items()}
+    assign = answer.get("assign", False)
+    if isinstance(assign, str):
+        assign = assign.strip().lower() == "true"
+    answer["assign"] = bool(assign)
+    answer.setdefault("expr", "Unknown expression")
+    answer.setdefault("result", "N/A")
+    return answer
+
+
+def parse_answers(text: str) -> ParseResult:
+    """Parses a model response into a `ParseResult` in a single pass over `text`."""
+    match = _START.search(text or "")
+    if match is None:
+        return ParseResult([], [(0, "No list or dict found")])
+
+    parser = _Parser(text)
+    if match.start() > 0 and text[:match.start()].strip():
+        parser.note("Ignored text before the answer", 0)
+    parser.pos = match.start()
+    value = parser.value(",]")
+    if isinstance(value, dict):
+        value = [value]
+
+    parser.skip_space()
+    if parser.pos < len(text):
+        parser.note("Ignored text after the answer")
+
+    answers = []
+    for item in value:
+        if isinstance(item, dict):
+            answers.append(_to_answer(item))
+        else:
+            parser.note(f"Ignored non-dict item {item!r}")
+    return ParseResult(answers, parser.diagnostics)
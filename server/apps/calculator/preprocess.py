@@ -0,0 +1,266 @@
+# This file prepares a canvas image before it is encoded and sent to the vision model.
+#
+# The client sends the whole full-screen canvas, even when the drawing only covers a small
+# corner of it. Encoding and uploading all of that empty space costs CPU, bandwidth and
+# model latency for nothing. The preprocessing stage therefore:
+#
+# 1. Finds the bounding box of the "ink" (the pixels the user actually drew on), using
+#    NumPy to threshold the alpha channel, or the brightness for images without alpha.
+# 2. Crops to that box plus a little padding, so strokes at the edge aren't clipped.
+# 3. Flattens transparency onto a background that contrasts with the ink. The canvas is
+#    transparent with white ink by default, which would vanish on a white background.
+# 4. Downscales the result so its longest side is at most `max_dim` pixels.
+# 5. Encodes it with whichever format is smallest while staying readable: a grayscale PNG
+#    for single-color drawings, otherwise the smaller of a palette PNG and a JPEG.
+#
+# Clients that send their strokes as vectors skip steps 1 to 4: `rasterize_strokes` draws
+# them straight into an image that is already cropped, flattened and scaled.
+
+import base64
+from io import BytesIO
+import math
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+# Pixels with an alpha above this value count as ink on transparent canvases.
+INK_ALPHA_THRESHOLD = 16
+
+# On opaque images, pixels whose brightness differs from the background by more than
+# this value count as ink.
+INK_LUMA_THRESHOLD = 32
+
+# Ink whose channels differ by less than this is treated as gray, so the drawing can be
+# sent as a single-channel image without losing any color information.
+MONOCHROME_SPREAD = 24
+
+# Strokes are drawn at this multiple of the output size and then scaled down, which
+# smooths their edges (PIL draws lines without anti-aliasing).
+STROKE_SUPERSAMPLE = 2
+
+
+def _luma(rgb: np.ndarray) -> np.ndarray:
+    # ITU-R BT.601 weights, the same ones PIL uses for `convert("L")`.
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+def ink_mask(img: Image.Image):
+    """Returns the RGB pixels, the alpha channel (or `None`) and a boolean ink mask."""
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = np.asarray(img if img.mode == "RGBA" else img.convert("RGBA"))
+        rgb = rgba[..., :3]
+        alpha = rgba[..., 3]
+        return rgb, alpha, alpha > INK_ALPHA_THRESHOLD
+
+    # No alpha channel: estimate the background from the image border and treat
+    # anything noticeably brighter or darker than it as ink.
+    rgb = np.asarray(img if img.mode == "RGB" else img.convert("RGB"))
+    luma = _luma(rgb.astype(np.float32))
+    border = np.concatenate((luma[0], luma[-1], luma[:, 0], luma[:, -1]))
+    mask = np.abs(luma - np.median(border)) > INK_LUMA_THRESHOLD
+    return rgb, None, mask
+
+
+def ink_bbox(mask: np.ndarray, padding: int):
+    """Returns the (left, upper, right, lower) box around the ink, or `None` if there is none."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    height, width = mask.shape
+    return (
+        max(int(cols[0]) - padding, 0),
+        max(int(rows[0]) - padding, 0),
+        min(int(cols[-1]) + 1 + padding, width),
+        min(int(rows[-1]) + 1 + padding, height),
+    )
+
+
+def prepare_image(img: Image.Image, max_dim: int, padding: int):
+    """
+    Crops `img` to its ink, flattens it and downscales it.
+
+    Returns an "L" image for single-color drawings, an "RGB" image otherwise, or `None`
+    when the canvas is blank.
+    """
+    rgb, alpha, mask = ink_mask(img)
+    box = ink_bbox(mask, padding)
+    if box is None:
+        return None
+    left, upper, right, lower = box
+    rgb = rgb[upper:lower, left:right]
+    mask = mask[upper:lower, left:right]
+
+    ink = rgb[mask]
+    spread = ink.max(axis=1).astype(np.int16) - ink.min(axis=1)
+    monochrome = np.percentile(spread, 98) < MONOCHROME_SPREAD
+
+    if alpha is not None:
+        # Composite onto white, unless more of the ink is near-white (the default white
+        # pen) than near-black, in which case composite onto black so it stays visible.
+        ink_luma = _luma(ink.astype(np.float32))
+        background = 0 if (ink_luma > 191).sum() > (ink_luma < 64).sum() else 255
+        coverage = alpha[upper:lower, left:right, None] / np.float32(255)
+        flat = rgb * coverage + np.float32(background) * (1 - coverage)
+        rgb = flat.round().astype(np.uint8)
+
+    if monochrome:
+        prepared = Image.fromarray(_luma(rgb.astype(np.float32)).round().astype(np.uint8), "L")
+    else:
+        prepared = Image.fromarray(np.ascontiguousarray(rgb), "RGB")
+
+    if max(prepared.size) > max_dim:
+        prepared.thumbnail((max_dim, max_dim), Image.LANCZOS, reducing_gap=2.0)
+    return prepared
+
+
+def encode_prepared(img: Image.Image):
+    """Encodes a prepared image as compactly as possible. Returns `(mime_type, base64_data)`."""
+    candidates = []
+
+    if img.mode == "L":
+        # Single-color line art compresses far better as PNG than as JPEG, and stays sharp.
+        buffered = BytesIO()
+        img.save(buffered, format="PNG", compress_level=6)
+        candidates.append(("image/png", buffered.getvalue()))
+    else:
+        # Drawings use a handful of pen colors, so a small palette keeps them intact.
+        buffered = BytesIO()
+        img.quantize(colors=64, method=Image.Quantize.FASTOCTREE).save(buffered, format="PNG", compress_level=6)
+        candidates.append(("image/png", buffered.getvalue()))
+
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG", quality=85)
+        candidates.append(("image/jpeg", buffered.getvalue()))
+
+    mime_type, data = min(candidates, key=lambda candidate: len(candidate[1]))
+    return mime_type, base64.b64encode(data).decode("utf-8")
+
+
+def ink_regions(img: Image.Image, cell: int):
+    """
+    Splits a canvas into separate drawings and returns their bounding boxes, top to bottom.
+
+    The ink mask is reduced to a coarse grid of `cell`-sized squares, and squares that
+    touch (including diagonally) are grouped into one region. Strokes closer together
+    than about one cell therefore end up in the same region, so the digits of one
+    expression stay together while expressions written further apart are split.
+    """
+    mask = ink_mask(img)[2]
+    height, width = mask.shape
+    rows, cols = -(-height // cell), -(-width // cell)
+    padded = np.zeros((rows * cell, cols * cell), dtype=bool)
+    padded[:height, :width] = mask
+    grid = padded.reshape(rows, cell, cols, cell).any(axis=(1, 3))
+
+    # Flood-fill the occupied cells. The grid is small (a 1920x1080 canvas with 24px
+    # cells is 80x45), so a plain Python stack is fast enough.
+    labels = np.zeros(grid.shape, dtype=np.int32)
+    boxes = []
+    for start_row, start_col in zip(*(index.tolist() for index in np.nonzero(grid))):
+        if labels[start_row, start_col]:
+            continue
+        label = len(boxes) + 1
+        labels[start_row, start_col] = label
+        stack = [(start_row, start_col)]
+        top, left, bottom, right = start_row, start_col, start_row, start_col
+        while stack:
+            r, c = stack.pop()
+            top, bottom = min(top, r), max(bottom, r)
+            left, right = min(left, c), max(right, c)
+            for nr in range(max(r - 1, 0), min(r + 2, rows)):
+                for nc in range(max(c - 1, 0), min(c + 2, cols)):
+                    if grid[nr, nc] and not labels[nr, nc]:
+                        labels[nr, nc] = label
+                        stack.append((nr, nc))
+        # Tighten the cell-aligned box to the actual ink inside it.
+        y0, y1 = top * cell, min((bottom + 1) * cell, height)
+        x0, x1 = left * cell, min((right + 1) * cell, width)
+        owned = (labels[top:bottom + 1, left:right + 1] == label).repeat(cell, axis=0).repeat(cell, axis=1)
+        l, u, r, b = ink_bbox(mask[y0:y1, x0:x1] & owned[:y1 - y0, :x1 - x0], 0)
+        boxes.append((x0 + l, y0 + u, x0 + r, y0 + b))
+
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def rasterize_strokes(strokes: list, max_dim: int, padding: int):
+    """
+    Draws vector strokes into an image ready for `encode_prepared`.
+
+    `strokes` is a list of `(points, color, width)` tuples, where `points` is a flat
+    `[x0, y0, x1, y1, ...]` list in canvas pixels and `color` any CSS color PIL
+    understands. The image is cropped to the strokes plus `padding`, scaled so its
+    longest side is at most `max_dim`, and flattened the same way as `prepare_image`.
+    Returns `None` when there are no strokes. Raises `ValueError` for malformed strokes.
+    """
+    paths = []
+    for points, color, width in strokes:
+        if not points or len(points) % 2:
+            raise ValueError("A stroke needs an even, non-zero number of coordinates")
+        xy = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if not np.isfinite(xy).all():
+            raise ValueError("Stroke coordinates must be finite numbers")
+        paths.append((xy, ImageColor.getrgb(color)[:3], max(float(width), 1.0)))
+    if not paths:
+        return None
+
+    left = min(float(xy[:, 0].min()) - width / 2 for xy, _, width in paths) - padding
+    top = min(float(xy[:, 1].min()) - width / 2 for xy, _, width in paths) - padding
+    right = max(float(xy[:, 0].max()) + width / 2 for xy, _, width in paths) + padding
+    bottom = max(float(xy[:, 1].max()) + width / 2 for xy, _, width in paths) + padding
+    scale = min(1.0, max_dim / max(right - left, bottom - top))
+    size = (max(math.ceil((right - left) * scale), 1), max(math.ceil((bottom - top) * scale), 1))
+
+    # Same choices as for bitmaps: gray ink becomes an "L" image, and the background is
+    # black when more of the ink (weighted by stroke length and width) is light than dark.
+    lumas = [_luma(np.asarray(rgb, dtype=np.float32)) for _, rgb, _ in paths]
+    weights = [(np.hypot(*np.diff(xy, axis=0).T).sum() + 1) * width for xy, _, width in paths]
+    light = sum(w for w, luma in zip(weights, lumas) if luma > 191)
+    dark = sum(w for w, luma in zip(weights, lumas) if luma < 64)
+    background = 0 if light > dark else 255
+    monochrome = all(max(rgb) - min(rgb) < MONOCHROME_SPREAD for _, rgb, _ in paths)
+
+    factor = scale * STROKE_SUPERSAMPLE
+    canvas = Image.new(
+        "L" if monochrome else "RGB",
+        (size[0] * STROKE_SUPERSAMPLE, size[1] * STROKE_SUPERSAMPLE),
+        background if monochrome else (background,) * 3,
+    )
+    draw = ImageDraw.Draw(canvas)
+    for (xy, rgb, width), luma in zip(paths, lumas):
+        fill = int(round(float(luma))) if monochrome else rgb
+        scaled = (xy - (left, top)) * factor
+        line_width = max(int(round(width * factor)), 1)
+        if len(scaled) > 1:
+            draw.line(scaled.ravel().tolist(), fill=fill, width=line_width, joint="curve")
+        # The client draws with round line caps, and a single point is a dot.
+        radius = line_width / 2
+        for x, y in (scaled[0], scaled[-1]):
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=fill)
+    return canvas.reduce(STROKE_SUPERSAMPLE)
+
+
+def runs(flags: np.ndarray):
+    """Start and end indices of every run of `True` values."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], flags.astype(np.int8), [0]))))
+    return edges[::2], edges[1::2]
+
+
+def line_bands(mask: np.ndarray) -> list:
+    """
+    Splits an ink mask into lines of writing. Returns `(top, bottom)` row ranges.
+
+    The rows that contain ink are grouped into horizontal bands, ignoring gaps shorter
+    than half the tallest band (the two bars of "=" or the dot of "÷").
+    """
+    starts, ends = runs(mask.any(axis=1))
+    if starts.size == 0:
+        return []
+    min_gap = (ends - starts).max() / 2
+    bands = [[int(starts[0]), int(ends[0])]]
+    for start, end in zip(starts[1:].tolist(), ends[1:].tolist()):
+        if start - bands[-1][1] >= min_gap:
+            bands.append([start, end])
+        else:
+            bands[-1][1] = end
+    return [tuple(band) for band in bands]
+
@@ -0,0 +1,133 @@
+# This file builds the text prompts sent to the vision model.
+#
+# The instructions are long (the PEMDAS rules, five kinds of problems and the output
+# format), and input tokens cost both money and time to first token. So:
+#
+# - The fixed sections are joined once, when this module is imported. A request only adds
+#   its variables, and the finished prompt is cached per template and variables, so
+#   repeated requests with the same variables reuse the same string.
+# - The variables are written as compact JSON, only the `PROMPT_MAX_VARS` most recently
+#   assigned ones are included, and the sentence about them is left out when there are
+#   none.
+# - When the drawing is known to be plain written math, a shorter template is used. Only
+#   drawings the local handwriting recognizer reads confidently ("12 + 7 =", "x = 4") get
+#   the `written` template, which only describes the three kinds of written math and
+#   skips the drawing cases. Everything else keeps the `full` one.
+#
+# Every prompt has a name, which `metrics.record_usage` uses to count tokens per template.
+
+import json
+from functools import lru_cache
+from typing import NamedTuple
+
+from constants import PROMPT_MAX_VARS
+
+
+class Prompt(NamedTuple):
+    name: str
+    text: str
+
+
+_INTRO = (
+    "You have been given an image with some mathematical expressions, equations, or graphical problems, and you need to solve them. "
+)
+
+_PEMDAS = (
+    "Note: Use the PEMDAS rule for solving mathematical expressions. PEMDAS stands for the Priority Order: Parentheses, Exponents, Multiplication and Division (from left to right), Addition and Subtraction (from left to right). Parentheses have the highest priority, followed by Exponents, then Multiplication and Division, and lastly Addition and Subtraction. "
+    "For example: "
+    "Q. 2 + 3 * 4 "
+    "(3 * 4) => 12, 2 + 12 = 14. "
+    "Q. 2 + 3 + 5 * 4 - 8 / 2 "
+    "5 * 4 => 20, 8 / 2 => 4, 2 + 3 => 5, 5 + 20 => 25, 25 - 4 => 21. "
+)
+
+# A one-line reminder of the same rule, for the shorter templates.
+_PEMDAS_SHORT = (
+    "Use the PEMDAS order: Parentheses, Exponents, Multiplication and Division (left to right), then Addition and Subtraction (left to right). "
+)
+
+_CASES = {
+    "expression": "Simple mathematical expressions like 2 + 2, 3 * 4, 5 / 6, 7 - 8, etc.: In this case, solve and return the answer in the format of a LIST OF ONE DICT [{'expr': given expression, 'result': calculated answer}]. ",
+    "equations": "Set of Equations like x^2 + 2x + 1 = 0, 3y + 4x = 0, 5x^2 + 6y + 7 = 12, etc.: In this case, solve for the given variable, and the format should be a COMMA SEPARATED LIST OF DICTS, with dict 1 as {'expr': 'x', 'result': 2, 'assign': True} and dict 2 as {'expr': 'y', 'result': 5, 'assign': True}. This example assumes x was calculated as 2, and y as 5. Include as many dicts as there are variables. ",
+    "assignment": "Assigning values to variables like x = 4, y = 5, z = 6, etc.: In this case, assign values to variables and return another key in the dict called {'assign': True}, keeping the variable as 'expr' and the value as 'result' in the original dictionary. RETURN AS A LIST OF DICTS. ",
+    "graphical": "Analyzing Graphical Math problems, which are word problems represented in drawing form, such as cars colliding, trigonometric problems, problems on the Pythagorean theorem, adding runs from a cricket wagon wheel, etc. These will have a drawing representing some scenario and accompanying information with the image. PAY CLOSE ATTENTION TO DIFFERENT COLORS FOR THESE PROBLEMS. You need to return the answer in the format of a LIST OF ONE DICT [{'expr': given expression, 'result': calculated answer}]. ",
+    "abstract": "Detecting Abstract Concepts that a drawing might show, such as love, hate, jealousy, patriotism, or a historic reference to war, invention, discovery, quote, etc. USE THE SAME FORMAT AS OTHERS TO RETURN THE ANSWER, where 'expr' will be the explanation of the drawing, and 'result' will be the abstract concept. ",
+}
+
+_COUNT_WORDS = {3: "THREE", 5: "FIVE"}
+
+_OUTRO = (
+    "Make sure to use extra backslashes for escape characters like \\f -> \\\\f, \\n -> \\\\n, etc. "
+    "DO NOT USE BACKTICKS OR MARKDOWN FORMATTING. "
+    "PROPERLY QUOTE THE KEYS AND VALUES IN THE DICTIONARY FOR EASIER PARSING WITH Python's ast.literal_eval."
+)
+
+_VARS = (
+    "Here is a dictionary of user-assigned variables. If the given expression has any of these variables, use its actual value from this dictionary accordingly: {}. "
+)
+
+
+def _cases(names: list) -> str:
+    listed = "".join(f"{i}. {_CASES[name]}" for i, name in enumerate(names, start=1))
+    return (
+        f"YOU CAN HAVE {_COUNT_WORDS[len(names)]} TYPES OF EQUATIONS/EXPRESSIONS IN THIS IMAGE, AND ONLY ONE CASE SHALL APPLY EVERY TIME: "
+        f"Following are the cases: {listed}"
+        f"Analyze the equation or expression in this image and return the answer according to the given rules: "
+    )
+
+
+# The fixed part of each template, everything except the variables and the closing rules.
+TEMPLATES = {
+    "full": _INTRO + _PEMDAS + _cases(["expression", "equations", "assignment", "graphical", "abstract"]),
+    "written": (
+        "You have been given an image with a handwritten mathematical expression, equation or variable assignment, and you need to solve it. "
+        + _PEMDAS_SHORT + _cases(["expression", "equations", "assignment"])
+    ),
+}
+
+TRANSCRIBE_PROMPT = Prompt("transcribe", (
+    "Transcribe the handwritten math in this image as plain text, one statement per line. "
+    "Use ^ for powers, * for multiplication and / for division. "
+    "Write only the math, with no explanation, backticks or markdown. "
+    "If the image shows a word problem, a diagram or a drawing rather than plain arithmetic, "
+    "equations or variable assignments, reply with exactly: NONE"
+))
+
+
+def compact_vars(dict_of_vars: dict, limit: int = PROMPT_MAX_VARS) -> str:
+    """
+    The variables as compact JSON, or "" when there are none.
+
+    Variables are kept in the order they were assigned, so the last `limit` entries are
+    the most recent ones.
+    """
+    if not dict_of_vars:
+        return ""
+    items = list(dict_of_vars.items())[-limit:] if limit > 0 else []
+    return json.dumps(dict(items), separators=(",", ":"), default=str)
+
+
+@lru_cache(maxsize=256)
+def _render(template: str, vars_json: str, images: int) -> str:
+    parts = [TEMPLATES[template]]
+    if vars_json:
+        parts.append(_VARS.format(vars_json))
+    if images > 1:
+        parts.append(
+            f"You have been given {images} separate images, numbered 1 to {images} in the order they appear. "
+            f"Solve each image independently using the rules above. "
+            f"Add an 'image' key with the image number to EVERY dict, e.g. {{'expr': '2 + 2', 'result': 4, 'image': 1}}. "
+            f"Return ONE LIST OF DICTS covering all images. "
+        )
+    parts.append(_OUTRO)
+    return "".join(parts)
+
+
+def build_prompt(dict_of_vars: dict, template: str = "full") -> Prompt:
+    """The solving prompt for one image, using one of `TEMPLATES`."""
+    return Prompt(template, _render(template, compact_vars(dict_of_vars), 1))
+
+
+def build_batch_prompt(dict_of_vars: dict, count: int) -> Prompt:
+    """The solving prompt for `count` images in one call; answers are tagged with 'image'."""
+    return Prompt("batch", _render("full", compact_vars(dict_of_vars), count))
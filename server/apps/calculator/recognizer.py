@@ -0,0 +1,295 @@
+# This file reads simple handwritten math locally, on the CPU, without calling Groq.
+#
+# It handles what most drawings are: a line or two of digits, operators and the
+# variables x and y ("12 + 7 =", "x = 4", "3x + 1 = 10"). It works in three steps:
+#
+# 1. Segmentation: the prepared image is split into lines (`line_bands`), and each line
+#    into symbols at the empty columns between them.
+# 2. Classification: each symbol is scaled into a small 16x16 grid, which together with
+#    its size and position within the line forms a feature vector. A k-nearest-neighbour
+#    classifier compares it with a set of reference glyphs. The share of neighbours that
+#    agree is the symbol's confidence.
+# 3. The symbols are joined into text for the local solver (`solver.py`).
+#
+# The reference glyphs are not a binary file: `GLYPHS` describes every symbol as a few
+# pen strokes, and `build_model` draws many variations of them (slanted, rotated,
+# squeezed, with different pen widths and a shaky hand). The model is built once per
+# process, in well under a second, and is deterministic.
+#
+# `recognize` returns the text and the confidence of its least certain symbol. Anything
+# unusual (touching digits, letters, dots, diagrams) either isn't close to any reference
+# glyph, doesn't read as a well-formed line of math, or gets a low confidence, and the
+# caller sends the drawing to the vision model instead. `recognize_once` remembers the
+# reading on the image, since in "auto" mode both the local analyzer and model routing
+# need it for the same drawing.
+
+import math
+import threading
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from .preprocess import runs, ink_mask, line_bands
+
+# Side of the square grid each symbol is scaled into.
+GRID = 16
+
+# How many reference glyphs vote on each symbol.
+NEIGHBOURS = 7
+
+# Variations drawn per glyph variant when building the model.
+SAMPLES_PER_VARIANT = 40
+
+# Symbols smaller than this share of the line height in both directions are dots (a
+# decimal point, the dots of "÷", noise), which this recognizer doesn't handle.
+DOT_SIZE = 0.15
+
+
+def _arc(cx, cy, rx, ry, start, end, steps=16):
+    """Points along an ellipse, with angles in degrees; 0 is right, 90 is down."""
+    angles = np.radians(np.linspace(start, end, steps))
+    return list(zip((cx + rx * np.cos(angles)).tolist(), (cy + ry * np.sin(angles)).tolist()))
+
+
+# Every symbol as one or more variants, each a list of strokes in a box where digits span
+# y = 0 (top) to y = 1 (baseline).
+GLYPHS = {
+    "0": [[_arc(0.3, 0.5, 0.3, 0.5, -90, 270, 24)]],
+    "1": [[[(0.3, 0.0), (0.3, 1.0)]], [[(0.1, 0.22), (0.3, 0.0), (0.3, 1.0)]]],
+    "2": [
+        [_arc(0.3, 0.28, 0.3, 0.28, 180, 400) + [(0.0, 1.0), (0.62, 1.0)]],
+        [_arc(0.3, 0.3, 0.3, 0.3, 200, 380) + [(0.05, 1.0), (0.62, 1.0)]],
+    ],
+    "3": [
+        [_arc(0.28, 0.25, 0.28, 0.25, 200, 450) + _arc(0.28, 0.73, 0.3, 0.27, 270, 520)],
+        [[(0.0, 0.0), (0.55, 0.0), (0.2, 0.42)] + _arc(0.27, 0.7, 0.3, 0.3, 250, 520)],
+    ],
+    "4": [
+        [[(0.42, 0.0), (0.0, 0.65), (0.62, 0.65)], [(0.45, 0.3), (0.45, 1.0)]],
+        [[(0.05, 0.0), (0.05, 0.6), (0.62, 0.6)], [(0.5, 0.0), (0.5, 1.0)]],
+    ],
+    "5": [
+        [[(0.55, 0.0), (0.1, 0.0), (0.07, 0.45)] + _arc(0.3, 0.68, 0.3, 0.32, 235, 500)],
+        [[(0.1, 0.0), (0.07, 0.45)] + _arc(0.3, 0.68, 0.3, 0.32, 235, 500), [(0.1, 0.0), (0.58, 0.0)]],
+    ],
+    "6": [[[(0.5, 0.02), (0.25, 0.2), (0.05, 0.55)] + _arc(0.3, 0.72, 0.27, 0.27, 180, 540)]],
+    "7": [[[(0.0, 0.0), (0.6, 0.0), (0.2, 1.0)]], [[(0.0, 0.0), (0.6, 0.0), (0.25, 1.0)], [(0.15, 0.5), (0.5, 0.5)]]],
+    "8": [[_arc(0.3, 0.25, 0.22, 0.24, 90, 450) + _arc(0.3, 0.74, 0.28, 0.26, 270, 630)]],
+    "9": [
+        [_arc(0.3, 0.28, 0.27, 0.27, 0, 360) + [(0.57, 0.28), (0.5, 1.0)]],
+        [_arc(0.3, 0.28, 0.27, 0.27, 0, 360) + [(0.57, 0.28), (0.57, 0.7)] + _arc(0.3, 0.7, 0.27, 0.3, 0, 150)],
+    ],
+    "+": [[[(0.3, 0.2), (0.3, 0.8)], [(0.0, 0.5), (0.6, 0.5)]]],
+    "-": [[[(0.0, 0.5), (0.6, 0.5)]]],
+    "=": [[[(0.0, 0.38), (0.6, 0.38)], [(0.0, 0.62), (0.6, 0.62)]]],
+    "x": [
+        [[(0.0, 0.35), (0.55, 1.0)], [(0.55, 0.35), (0.0, 1.0)]],
+        [[(0.05, 0.25), (0.55, 0.75)], [(0.55, 0.25), (0.05, 0.75)]],
+    ],
+    "y": [[[(0.0, 0.35), (0.3, 0.85)], [(0.55, 0.35), (0.15, 1.3)]]],
+    "(": [[_arc(0.45, 0.5, 0.4, 0.6, 235, 125)]],
+    ")": [[_arc(-0.05, 0.5, 0.4, 0.6, -55, 55)]],
+    "/": [[[(0.5, 0.0), (0.0, 1.0)]]],
+}
+
+DIGITS = set("0123456789")
+OPERANDS = DIGITS | {"x", "y", "(", ")"}
+OPERATORS = {"+", "-", "*", "/", "="}
+
+
+def features(mask: np.ndarray, band_top: float, band_height: float) -> np.ndarray:
+    """
+    The feature vector of one symbol: its cropped ink `mask` scaled into the grid, plus
+    its shape and its size and position relative to the line (`band_top`, `band_height`).
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    height, width = crop.shape
+    scale = (GRID - 2) / max(height, width)
+    size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+    small = Image.fromarray((crop * 255).astype(np.uint8)).resize(size, Image.BOX)
+    grid = Image.new("L", (GRID, GRID), 0)
+    grid.paste(small, ((GRID - size[0]) // 2, (GRID - size[1]) // 2))
+    pixels = np.asarray(grid.filter(ImageFilter.GaussianBlur(0.8)), dtype=np.float32).ravel()
+    pixels /= np.linalg.norm(pixels) or 1.0
+    center = (rows[0] + rows[-1] + 1) / 2
+    shape = np.array([
+        np.clip(math.log(width / height), -3, 3) * 0.15,
+        height / band_height * 0.5,
+        ((center - band_top) / band_height - 0.5) * 0.5,
+    ], dtype=np.float32)
+    return np.concatenate((pixels, shape))
+
+
+def _render(strokes, rng) -> tuple:
+    """Draws one random variation of a glyph. Returns `(mask, band_top, band_height)`."""
+    cap = 48.0
+    slant = rng.uniform(-0.25, 0.25)
+    angle = math.radians(rng.uniform(-7, 7))
+    sx, sy = rng.uniform(0.75, 1.3), rng.uniform(0.9, 1.1)
+    cos, sin = math.cos(angle), math.sin(angle)
+    width = max(cap * rng.uniform(0.06, 0.15), 1.5)
+
+    def transform(x, y):
+        x, y = (x - 0.3) * sx - slant * (y - 0.5), (y - 0.5) * sy
+        return (x * cos - y * sin) * cap + 2 * cap, (x * sin + y * cos) * cap + 2 * cap
+
+    img = Image.new("L", (int(4 * cap), int(4 * cap)), 0)
+    draw = ImageDraw.Draw(img)
+    for stroke in strokes:
+        points = np.array(stroke) + rng.normal(0, 0.015, (len(stroke), 2))
+        xy = [transform(x, y) for x, y in points.tolist()]
+        if len(xy) > 1:
+            draw.line(xy, fill=255, width=int(round(width)), joint="curve")
+        for x, y in (xy[0], xy[-1]):
+            draw.ellipse((x - width / 2, y - width / 2, x + width / 2, y + width / 2), fill=255)
+    # The line's extent varies with what else is written on it (parentheses, a "y").
+    top = transform(0.3, 0.0)[1] - cap * sy * rng.uniform(0, 0.15)
+    bottom = transform(0.3, 1.0)[1] + cap * sy * rng.uniform(0, 0.15)
+    return np.asarray(img) > 127, top, bottom - top
+
+
+class GlyphModel:
+    """The reference glyphs' feature vectors and labels, and the k-NN classifier over them."""
+
+    def __init__(self, vectors: np.ndarray, labels: list, max_distance: float):
+        self.vectors = vectors
+        self.labels = np.array(labels)
+        self.max_distance = max_distance
+
+    def classify(self, vector: np.ndarray):
+        """Returns `(label, confidence)` for one feature vector."""
+        distances = np.linalg.norm(self.vectors - vector, axis=1)
+        nearest = np.argpartition(distances, NEIGHBOURS)[:NEIGHBOURS]
+        # Far from every reference glyph: not a symbol we know.
+        if distances[nearest].min() > self.max_distance:
+            return None, 0.0
+        weights = 1 / (distances[nearest] + 1e-3)
+        votes = {}
+        for label, weight in zip(self.labels[nearest].tolist(), weights.tolist()):
+            votes[label] = votes.get(label, 0.0) + weight
+        label = max(votes, key=votes.get)
+        return label, float(votes[label] / weights.sum())
+
+
+def build_model(seed: int = 0) -> GlyphModel:
+    rng = np.random.default_rng(seed)
+    vectors, labels = [], []
+    for label, variants in GLYPHS.items():
+        for strokes in variants:
+            for _ in range(SAMPLES_PER_VARIANT):
+                mask, top, height = _render(strokes, rng)
+                vectors.append(features(mask, top, height))
+                labels.append(label)
+    vectors = np.stack(vectors)
+    # The distance beyond which a symbol is "unknown": a little more than how far apart
+    # neighbouring variations of the same glyph are.
+    sample = rng.choice(len(vectors), size=min(300, len(vectors)), replace=False)
+    gaps = []
+    for i in sample.tolist():
+        distances = np.linalg.norm(vectors - vectors[i], axis=1)
+        distances[i] = np.inf
+        gaps.append(distances.min())
+    return GlyphModel(vectors, labels, float(np.percentile(gaps, 99)) * 1.5)
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model() -> GlyphModel:
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = build_model()
+        return _model
+
+
+def segment_line(mask: np.ndarray, top: int, bottom: int) -> list:
+    """Splits one line of `mask` into symbols at its empty columns. Returns column ranges."""
+    starts, ends = runs(mask[top:bottom].any(axis=0))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _join(symbols: list) -> list:
+    """
+    Groups the symbols of one line into solver tokens, e.g. ['1', '2', '+', 'x'] becomes
+    ['12', '+', 'x'].
+    """
+    parts = []
+    for i, symbol in enumerate(symbols):
+        if symbol == "x":
+            # An "x" between two numbers is a multiplication sign, not the variable.
+            before = symbols[i - 1] if i > 0 else ""
+            after = symbols[i + 1] if i + 1 < len(symbols) else ""
+            if (before in DIGITS or before == ")") and (after in DIGITS or after == "("):
+                symbol = "*"
+        if parts and symbol in OPERANDS and parts[-1][-1] in OPERANDS:
+            # "12", "2x", "3(", "(x": written together, as the solver reads implicit products.
+            parts[-1] += symbol
+        else:
+            parts.append(symbol)
+    # "12 + 7 =" asks for the result of "12 + 7".
+    if parts and parts[-1] == "=":
+        parts.pop()
+    return parts
+
+
+def _well_formed(parts: list) -> bool:
+    """
+    Whether the tokens of a line read as math: at least two operands with one operator
+    between each pair, at most one "=", a number somewhere and balanced parentheses.
+    Scribbles and words that happen to look like symbols rarely pass.
+    """
+    if len(parts) < 3 or len(parts) % 2 == 0:
+        return False
+    if any(part in OPERATORS for part in parts[0::2]) or any(part not in OPERATORS for part in parts[1::2]):
+        return False
+    text = "".join(parts)
+    depth = 0
+    for char in text:
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth < 0:
+            return False
+    return depth == 0 and text.count("=") <= 1 and any(char in DIGITS for char in text)
+
+
+def recognize(img: Image.Image):
+    """
+    Reads a prepared image. Returns `(text, confidence)`, with one statement per line, or
+    `None` when the drawing doesn't look like symbols this recognizer knows.
+    """
+    mask = ink_mask(img)[2]
+    model = get_model()
+    lines = []
+    confidence = 1.0
+    for top, bottom in line_bands(mask):
+        height = bottom - top
+        symbols = []
+        for left, right in segment_line(mask, top, bottom):
+            symbol = mask[top:bottom, left:right]
+            rows = np.flatnonzero(symbol.any(axis=1))
+            if right - left < DOT_SIZE * height and rows[-1] + 1 - rows[0] < DOT_SIZE * height:
+                return None
+            label, certainty = model.classify(features(symbol, 0, height))
+            if label is None:
+                return None
+            symbols.append(label)
+            confidence = min(confidence, certainty)
+        parts = _join(symbols)
+        if not _well_formed(parts):
+            return None
+        lines.append(" ".join(parts))
+    if not lines:
+        return None
+    return "\n".join(lines), confidence
+
+
+def recognize_once(img: Image.Image):
+    """`recognize`, computed at most once per image object and then remembered on it."""
+    try:
+        return img._recognized
+    except AttributeError:
+        img._recognized = recognize(img)
+        return img._recognized
@@ -4,18 +4,83 @@
 
 # `APIRouter` is a class from FastAPI that allows you to create a "mini" FastAPI application.
 # You can define routes on it, and then include this router in your main `app` instance.
-from fastapi import APIRouter, HTTPException
-from schema import ImagePayload # Import the Pydantic model for our request body.
-from .utils import analyze # Correctly import the 'analyze' function.
-import base64
-from io import BytesIO
-from PIL import Image
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from schema import ImagePayload, ExpressionPayload, BatchPayload, StrokePayload # Import the Pydantic models for our request bodies.
+from .utils import analyze, analyze_batch, analyze_incremental, analyze_stream, analyze_strokes, decode_data_url, run_in_image_executor # Correctly import the 'analyze' function.
+from .preprocess import ink_regions
+from .upload import InvalidUpload, UnsupportedUpload, UploadTooLarge, decode_upload, read_body
+from constants import BATCH_MAX_IMAGES, REGION_CELL_SIZE, STROKES_MAX_POINTS, UPLOAD_MAX_BYTES
+from logging_config import SAMPLED
+from metrics import ERRORS, REQUESTS, span
+import asyncio
+from .limiter import UpstreamBusy
+from .solver import UnsupportedExpression, solve_text
 import json
+import logging
 
 # Create an instance of APIRouter. This `router` object is what we'll use to
 # define all the routes for this module.
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# How often a waiting request checks whether its client is still connected.
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """
+    Awaits `coro`, but cancels it if the client disconnects first. FastAPI keeps running a
+    handler after its client has gone; for a request coalesced onto a shared upstream call
+    this lets the call be dropped once nobody is waiting for it.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("Client disconnected while waiting for a result")
+                # 499 is the de-facto "client closed request" status; nobody will read it.
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        task.cancel()
+
+
+def format_results(analysis_result) -> list:
+    """Brings any analysis result into the list-of-dicts shape the frontend expects."""
+    with span("normalize"):
+        return _format_results(analysis_result)
+
+
+def _format_results(analysis_result) -> list:
+    # Ensure we're returning a list
+    if not isinstance(analysis_result, list):
+        analysis_result = [analysis_result]
+
+    # If the list is empty, provide a default result
+    if len(analysis_result) == 0:
+        analysis_result = [{"expr": "No expression detected", "result": "N/A", "assign": False}]
+
+    # Convert all results to proper format
+    for item in analysis_result:
+        # Ensure all required fields are present
+        if "expr" not in item:
+            item["expr"] = "Unknown expression"
+        if "result" not in item:
+            item["result"] = "N/A"
+        if "assign" not in item:
+            item["assign"] = False
+
+        # Convert numeric values to strings for JSON serialization if needed
+        if isinstance(item["result"], (int, float)):
+            item["result"] = str(item["result"])
+
+    return analysis_result
+
+
 # --- Path Operation Decorator ---
 # This decorator registers the function below it as an API endpoint.
 # - `@router.post("/")`: This means this endpoint will respond to HTTP POST requests.
@@ -26,7 +91,7 @@ router = APIRouter()
 #   While we are returning a dictionary here, you could also use a Pydantic model
 #   from `schema.py` for stronger validation and better documentation.
 @router.post("/", response_model=list)
-async def calculate_from_image(payload: ImagePayload):
+async def calculate_from_image(payload: ImagePayload, request: Request):
     """
     This is the main endpoint for the calculator. It receives the drawing of a
     mathematical expression from the frontend, processes it, and returns the result.
@@ -45,50 +110,221 @@ async def calculate_from_image(payload: ImagePayload):
         image_data_url = payload.data
         variables = payload.dict_of_vars
 
-        print(f"Received variables: {variables}")
+        REQUESTS.inc(endpoint="calculate")
+        logger.debug("Received variables: %s", variables, extra=SAMPLED)
 
         # Extract the base64 encoded image data
         if "," in image_data_url:
-            header, encoded = image_data_url.split(",", 1)
-            image_data = base64.b64decode(encoded)
-            image = Image.open(BytesIO(image_data))
+            # Decoding a full-screen PNG is CPU work, so it runs on the image thread
+            # pool rather than on the event loop.
+            image = await run_in_image_executor(decode_data_url, image_data_url)
 
             # --- Calling the analyze function ---
             # Now we call the imported 'analyze' function with the processed image and variables.
-            analysis_result = analyze(img=image, dict_of_vars=variables)
-            
-            print(f"Analysis result: {analysis_result}")
-            
-            # Ensure we're returning a list
-            if not isinstance(analysis_result, list):
-                analysis_result = [analysis_result]
-                
-            # If the list is empty, provide a default result
-            if len(analysis_result) == 0:
-                analysis_result = [{"expr": "No expression detected", "result": "N/A", "assign": False}]
-            
-            # Convert all results to proper format
-            for item in analysis_result:
-                # Ensure all required fields are present
-                if "expr" not in item:
-                    item["expr"] = "Unknown expression"
-                if "result" not in item:
-                    item["result"] = "N/A"
-                if "assign" not in item:
-                    item["assign"] = False
-                    
-                # Convert numeric values to strings for JSON serialization if needed
-                if isinstance(item["result"], (int, float)):
-                    item["result"] = str(item["result"])
-                
-            # Print the response in JSON format for debugging
-            print(json.dumps(analysis_result))
+            # `await` hands the event loop back to other requests while Groq is thinking.
+            # With a session id, only the parts of the canvas that changed since the
+            # session's previous request are solved.
+            if payload.session_id:
+                analysis = analyze_incremental(image, variables, payload.session_id)
+            else:
+                analysis = analyze(img=image, dict_of_vars=variables)
+            analysis_result = await cancel_on_disconnect(request, analysis)
             
+            analysis_result = format_results(analysis_result)
+            logger.debug("Analysis result: %s", analysis_result, extra=SAMPLED)
+
             return analysis_result
         else:
             raise HTTPException(status_code=400, detail="Invalid image data format")
+    except UpstreamBusy as e:
+        # Too many requests are already waiting on Groq. Tell the client to retry
+        # shortly instead of letting the request queue up indefinitely.
+        ERRORS.inc(type="UpstreamBusy")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        ERRORS.inc(type=type(e).__name__)
+        logger.exception("Error processing request: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+
+@router.post("/upload", response_model=list)
+async def calculate_from_upload(request: Request, dict_of_vars: str = "{}"):
+    """
+    Same as `/calculate/`, but the request body is the image itself instead of a JSON
+    document with a base64 data URL, which saves the size and decoding overhead of both.
+
+    The body is a PNG or WebP file, or a run-length encoded canvas
+    (`Content-Type: application/x-canvas-rle`, see `upload.py` for the format). The
+    variables are passed as a JSON object in the `dict_of_vars` query parameter.
+    """
+    REQUESTS.inc(endpoint="upload")
+    try:
+        variables = json.loads(dict_of_vars)
+    except json.JSONDecodeError:
+        variables = None
+    if not isinstance(variables, dict):
+        raise HTTPException(status_code=422, detail="dict_of_vars must be a JSON object")
+
+    try:
+        with span("read_body"):
+            body = await read_body(request, UPLOAD_MAX_BYTES)
+        image = await run_in_image_executor(decode_upload, body, request.headers.get("content-type", ""))
+        analysis_result = await cancel_on_disconnect(request, analyze(img=image, dict_of_vars=variables))
+        return format_results(analysis_result)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedUpload as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except InvalidUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UpstreamBusy as e:
+        ERRORS.inc(type="UpstreamBusy")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        ERRORS.inc(type=type(e).__name__)
+        logger.exception("Error processing upload request: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+
+@router.post("/strokes", response_model=list)
+async def calculate_from_strokes(payload: StrokePayload, request: Request):
+    """
+    Same as `/calculate/`, but the drawing is sent as the list of strokes the user drew
+    instead of a screenshot of the canvas. This is a few kilobytes instead of megabytes,
+    and the server renders it at exactly the size the vision model needs, keeping colors.
+    """
+    REQUESTS.inc(endpoint="strokes")
+    if sum(len(stroke.points) for stroke in payload.strokes) // 2 > STROKES_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"At most {STROKES_MAX_POINTS} points per request")
+    strokes = [(stroke.points, stroke.color, stroke.width) for stroke in payload.strokes]
+
+    try:
+        analysis_result = await cancel_on_disconnect(request, analyze_strokes(strokes, payload.dict_of_vars))
+        return format_results(analysis_result)
+    except ValueError as e:
+        # Odd number of coordinates or an unknown color.
+        raise HTTPException(status_code=422, detail=str(e))
+    except UpstreamBusy as e:
+        ERRORS.inc(type="UpstreamBusy")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        ERRORS.inc(type=type(e).__name__)
+        logger.exception("Error processing strokes request: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+
+@router.post("/expression", response_model=list)
+async def calculate_from_expression(payload: ExpressionPayload):
+    """
+    Solves a typed (or previously transcribed) expression entirely on the server.
+
+    This handles plain arithmetic, variable assignments, systems of linear equations and
+    single-variable quadratics, and returns the same list of dicts as `/calculate/`.
+    Anything else is rejected with a 422 so the client can send the drawing instead.
+    """
+    REQUESTS.inc(endpoint="expression")
+    try:
+        # Solving is CPU work (an expanded polynomial can have hundreds of terms), so it
+        # runs on the image threads instead of the event loop.
+        answers = await run_in_image_executor(solve_text, payload.expression, payload.dict_of_vars)
+        return format_results(answers)
+    except UnsupportedExpression as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.post("/stream")
+async def calculate_from_image_stream(payload: ImagePayload):
+    """
+    Streaming version of `/calculate/`. Instead of one JSON list at the end, the response
+    is newline-delimited JSON (NDJSON): one event object per line, sent as soon as it is
+    available.
+
+    - `{"event": "progress", "stage": ...}` as the request moves through the pipeline.
+    - `{"event": "result", "data": {"expr": ..., "result": ..., "assign": ...}}` for each
+      answer, the moment the model has finished writing it.
+    - `{"event": "done", "count": n}` at the end, or `{"event": "error", "detail": ...}`.
+    """
+    if "," not in payload.data:
+        raise HTTPException(status_code=400, detail="Invalid image data format")
+
+    REQUESTS.inc(endpoint="stream")
+
+    async def events():
+        count = 0
+        try:
+            yield json.dumps({"event": "progress", "stage": "received"}) + "\n"
+            image = await run_in_image_executor(decode_data_url, payload.data)
+            async for event, data in analyze_stream(img=image, dict_of_vars=payload.dict_of_vars):
+                if event == "progress":
+                    yield json.dumps({"event": "progress", "stage": data}) + "\n"
+                else:
+                    count += 1
+                    yield json.dumps({"event": "result", "data": format_results([dict(data)])[0]}) + "\n"
+            if count == 0:
+                yield json.dumps({"event": "result", "data": format_results([])[0]}) + "\n"
+            yield json.dumps({"event": "done", "count": count}) + "\n"
+        except Exception as e:
+            # The 200 status line has already been sent, so errors (including a full
+            # upstream queue) are reported as a final event instead of an HTTP status.
+            ERRORS.inc(type=type(e).__name__)
+            logger.exception("Error processing streaming request: %s", e)
+            busy = isinstance(e, UpstreamBusy)
+            yield json.dumps({"event": "error", "detail": str(e), "retry": busy}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@router.post("/batch", response_model=list)
+async def calculate_batch(payload: BatchPayload):
+    """
+    Solves many drawings in one request, packing several of them into each Groq call.
+
+    Returns one entry per drawing, in order:
+    `{"index": i, "region": [left, top, right, bottom] or None, "results": [...]}`,
+    where `index` is the position of the source image in `images` and `region` is the
+    part of that image the results belong to (only set when `split_regions` is true).
+    """
+    if any("," not in image_data_url for image_data_url in payload.images):
+        raise HTTPException(status_code=400, detail="Invalid image data format")
+    if len(payload.images) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_IMAGES} images per batch")
+
+    REQUESTS.inc(endpoint="batch")
+    try:
+        images = await asyncio.gather(
+            *(run_in_image_executor(decode_data_url, image_data_url) for image_data_url in payload.images)
+        )
+
+        # Each item is (source index, region box or None, image to analyze).
+        items = []
+        if payload.split_regions:
+            all_regions = await asyncio.gather(
+                *(run_in_image_executor(ink_regions, image, REGION_CELL_SIZE) for image in images)
+            )
+            for index, (image, regions) in enumerate(zip(images, all_regions)):
+                items.extend((index, list(box), image.crop(box)) for box in regions)
+            if len(items) > BATCH_MAX_IMAGES:
+                raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_IMAGES} regions per batch")
+        else:
+            items = [(index, None, image) for index, image in enumerate(images)]
+
+        results = await analyze_batch([image for _, _, image in items], payload.dict_of_vars)
+        return [
+            {"index": index, "region": region, "results": format_results(answers)}
+            for (index, region, _), answers in zip(items, results)
+        ]
+    except UpstreamBusy as e:
+        ERRORS.inc(type="UpstreamBusy")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error processing request: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
\ No newline at end of file
+        ERRORS.inc(type=type(e).__name__)
+        logger.exception("Error processing batch request: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
@@ -0,0 +1,130 @@
+# This file remembers, per drawing session, which parts of the canvas were already solved.
+#
+# The usual interaction is: draw an equation, press "Calculate", add one more line, press
+# "Calculate" again. Without any memory the second press sends the whole canvas and the
+# model solves every expression again. With a session id on the request, the server:
+#
+# 1. Splits the canvas into ink regions (`ink_regions`, separate groups of strokes) and
+#    fingerprints each one by its pixels.
+# 2. Looks up the session's previous state: a list of *groups*, each the set of regions
+#    that were solved together plus the answers that call returned.
+# 3. Keeps every group whose regions are all still on the canvas, unchanged, as long as
+#    its answers assigned a variable ("x = 4", or a solved equation). Everything else is
+#    drawn onto an empty canvas and solved in one upstream call, with the assignments
+#    from the kept groups added to `dict_of_vars`: new regions, changed regions, regions
+#    whose group lost a member, and, once anything changed, groups without assignments.
+#    Those can't be reused on their own: a lone equation of a system gets solved alone,
+#    and a diagram needs the labels drawn next to it.
+# 4. Returns the kept answers followed by the new ones, and stores the new group.
+#
+# Session state is a small JSON document held in one of the backends from `cache.py`, so it
+# has the same byte budget, LRU eviction and expiry as the result cache. With several
+# workers it lives in a SQLite file, since consecutive requests of one session can be
+# handled by different workers.
+
+import hashlib
+import json
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from .cache import MemoryBackend, SQLiteBackend, cache_key
+from .preprocess import ink_regions
+
+
+class SessionStore:
+    """Maps a session id to the regions and answers of its last calculation."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, session_id: str, dict_of_vars: dict) -> list:
+        """Returns the stored groups, or an empty list if the variables have changed."""
+        value = self.backend.get(session_id)
+        if value is None:
+            return []
+        state = json.loads(value)
+        # The answers were computed with the variables of that request; different
+        # variables may change any of them.
+        if state["vars"] != cache_key(b"", dict_of_vars):
+            return []
+        return state["groups"]
+
+    def set(self, session_id: str, dict_of_vars: dict, groups: list):
+        state = {"vars": cache_key(b"", dict_of_vars), "groups": groups}
+        self.backend.set(session_id, json.dumps(state, default=str))
+
+    def __len__(self):
+        return len(self.backend)
+
+
+def build_session_store(backend: str, max_bytes: int, ttl: float, path: str) -> SessionStore:
+    backend = (backend or "memory").lower()
+    if backend == "memory":
+        return SessionStore(MemoryBackend(max_bytes, ttl))
+    if backend == "sqlite":
+        return SessionStore(SQLiteBackend(path, max_bytes, ttl, table="sessions"))
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend!r}")
+
+
+def segment(img: Image.Image, cell: int) -> list:
+    """Splits the canvas into ink regions. Returns `(box, fingerprint)` pairs, top to bottom."""
+    pixels = np.asarray(img if img.mode in ("RGBA", "RGB", "L") else img.convert("RGBA"))
+    regions = []
+    for left, upper, right, lower in ink_regions(img, cell):
+        crop = np.ascontiguousarray(pixels[upper:lower, left:right])
+        # The fingerprint ignores the position, so moving a drawing doesn't re-solve it.
+        digest = hashlib.sha256(f"{crop.shape}".encode("ascii"))
+        digest.update(crop.tobytes())
+        regions.append(((left, upper, right, lower), digest.hexdigest()))
+    return regions
+
+
+def compose_regions(img: Image.Image, boxes: list) -> Image.Image:
+    """Copies only the given regions of `img` onto an otherwise empty canvas."""
+    source = img if img.mode == "RGBA" else img.convert("RGBA")
+    canvas = Image.new("RGBA", source.size, (0, 0, 0, 0))
+    for box in boxes:
+        canvas.paste(source.crop(box), box[:2])
+    return canvas
+
+
+def plan(groups: list, regions: list):
+    """
+    Compares the stored `groups` with the current `regions`.
+
+    Returns `(kept_groups, changed_boxes, changed_fingerprints)`: the groups that can be
+    reused as they are, and the regions that have to be solved again.
+    """
+    # Counted rather than a set, since the same drawing can appear twice on a canvas.
+    available = Counter(fingerprint for _, fingerprint in regions)
+    kept = []
+    for group in groups:
+        needed = Counter(group["regions"])
+        if all(available[fingerprint] >= count for fingerprint, count in needed.items()):
+            kept.append(group)
+            available -= needed
+    # Something is new or changed: only groups that assigned variables stand on their
+    # own, and the rest are solved again together with the new regions.
+    if +available:
+        for group in kept:
+            if not assignments([group]):
+                available += Counter(group["regions"])
+        kept = [group for group in kept if assignments([group])]
+    changed = []
+    for box, fingerprint in regions:
+        if available[fingerprint] > 0:
+            available[fingerprint] -= 1
+            changed.append((box, fingerprint))
+    return kept, [box for box, _ in changed], [fingerprint for _, fingerprint in changed]
+
+
+def assignments(groups: list) -> dict:
+    """The variables assigned by the answers of `groups`, e.g. {'x': 4} for "x = 4"."""
+    assigned = {}
+    for group in groups:
+        for answer in group["answers"]:
+            if answer.get("assign") is True and "expr" in answer and "result" in answer:
+                assigned[str(answer["expr"])] = answer["result"]
+    return assigned
@@ -0,0 +1,79 @@
+# This file makes identical calculations that overlap in time share one upstream call.
+#
+# A double-click, or the same drawing submitted from two tabs, arrives as two requests
+# with the same image and variables. The result cache only helps once the first call has
+# finished; while it is still in flight, every duplicate would start its own Groq call.
+# `SingleFlight` runs the work for a key once and lets every concurrent caller with the
+# same key wait on that one task.
+#
+# Cancellation: each caller waits through `asyncio.shield`, so one caller going away
+# (e.g. its client disconnected) doesn't cancel the shared task for the others. When the
+# last caller has gone, nobody needs the answer any more and the task is cancelled, which
+# also releases its upstream slot.
+
+import asyncio
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.started = 0      # Calls that actually ran.
+        self.coalesced = 0    # Callers that joined a call already in flight.
+        self.abandoned = 0    # Calls cancelled because every caller went away.
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, factory):
+        """
+        Returns the result of `await factory()`, sharing it with concurrent callers of the
+        same `key`. Returns `(result, shared)`; `shared` is True when this caller joined a
+        call started by someone else, and so must not mutate the result in place.
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            call = _Call(asyncio.ensure_future(factory()))
+            self._calls[key] = call
+            self.started += 1
+            call.task.add_done_callback(lambda task: self._finished(key, call))
+
+        call.waiters += 1
+        try:
+            result = await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # Either this caller was cancelled (the task may still be running for others)
+            # or the task itself was cancelled. Only the first case needs bookkeeping.
+            if not call.task.done():
+                call.waiters -= 1
+                if call.waiters == 0:
+                    self._abandon(key, call)
+            raise
+        call.waiters -= 1
+        return result, shared
+
+    def _abandon(self, key, call: _Call):
+        self.abandoned += 1
+        # Forget the call right away so a new request for the same key starts afresh
+        # instead of joining a task that is being torn down.
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        call.task.cancel()
+
+    def _finished(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark a failure as retrieved when nobody was left to see it.
+        if not call.task.cancelled():
+            call.task.exception()
@@ -0,0 +1,451 @@
+# This file is a small, deterministic math engine that runs entirely on the server.
+#
+# Simple arithmetic ("2 + 3 * 4"), variable assignments ("x = 4") and small systems of
+# linear or quadratic equations don't need a vision model to be solved once their text is
+# known. `solve_text` takes that text (typed by the user, or transcribed from the drawing)
+# and produces the same `{'expr', 'result', 'assign'}` dicts as the model would.
+#
+# Safety: nothing here calls `eval`. The text is parsed with Python's `ast` module and the
+# resulting tree is walked by hand, allowing only numbers, known variables, the arithmetic
+# operators and a short list of math functions. Anything else raises `UnsupportedExpression`,
+# which callers use as the signal to fall back to the model.
+#
+# Exactness: numbers are kept as `Fraction`s for as long as possible, so "0.1 + 0.2" is 0.3
+# and "1 / 3 * 3" is 1. Only irrational operations (square roots, trig, logs, fractional
+# powers) switch to floating point.
+
+import ast
+import functools
+import math
+import re
+from fractions import Fraction
+
+
+class UnsupportedExpression(ValueError):
+    """Raised when the text can't be solved locally and should go to the model instead."""
+
+
+# Functions and constants that may appear in an expression.
+FUNCTIONS = {
+    "sqrt": math.sqrt,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+    "log": math.log10,
+    "ln": math.log,
+    "abs": abs,
+}
+CONSTANTS = {"pi": math.pi, "e": math.e}
+
+# Guards against inputs like "9^9^9" that would take forever to compute exactly.
+MAX_EXPONENT = 1024
+MAX_POLYNOMIAL_DEGREE = 8
+MAX_RESULT_BITS = 1 << 16
+MAX_RESULT_DIGITS = 4000
+# ...and against ones like "(a+b+c+d+f+g+h)^8" that expand into thousands of terms.
+MAX_POLYNOMIAL_TERMS = 256
+MAX_UNKNOWNS = 8
+
+# Handwriting and typesetting symbols mapped onto Python operators.
+_REPLACEMENTS = {
+    "×": "*", "·": "*", "∙": "*", "÷": "/", "−": "-", "–": "-",
+    "^": "**", "²": "**2", "³": "**3", "√": "sqrt", "π": "pi",
+}
+_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*|\.\d+)|([A-Za-z_][A-Za-z0-9_]*)|(\*\*|[-+*/%(),=]))")
+
+
+# --- Polynomials ---
+# Every sub-expression evaluates to a polynomial: a dict mapping a monomial to its
+# coefficient. A monomial is a sorted tuple of (variable, power) pairs; the constant term
+# uses the empty tuple. Plain numbers are just polynomials with only a constant term,
+# which lets a single evaluator handle both expressions and equations.
+
+def _const(value):
+    return {(): value} if value != 0 else {}
+
+
+def _constant_value(poly):
+    if any(monomial for monomial in poly):
+        raise UnsupportedExpression("Expression still contains unknown variables")
+    return poly.get((), Fraction(0))
+
+
+def _check_size(poly):
+    if len(poly) > MAX_POLYNOMIAL_TERMS:
+        raise UnsupportedExpression("Expression has too many terms")
+    return poly
+
+
+def _add(a, b, sign=1):
+    out = dict(a)
+    for monomial, coeff in b.items():
+        value = out.get(monomial, 0) + sign * coeff
+        if value == 0:
+            out.pop(monomial, None)
+        else:
+            out[monomial] = value
+    return _check_size(out)
+
+
+def _mul(a, b):
+    out = {}
+    for m1, c1 in a.items():
+        for m2, c2 in b.items():
+            powers = dict(m1)
+            for var, power in m2:
+                powers[var] = powers.get(var, 0) + power
+            monomial = tuple(sorted(powers.items()))
+            value = out.get(monomial, 0) + c1 * c2
+            if value == 0:
+                out.pop(monomial, None)
+            else:
+                out[monomial] = value
+        # Checked per row, so a huge product is abandoned before it is fully expanded.
+        _check_size(out)
+    return out
+
+
+def _degree(poly):
+    return max((sum(power for _, power in monomial) for monomial in poly), default=0)
+
+
+def _variables(poly):
+    return {var for monomial in poly for var, _ in monomial}
+
+
+def _real(value):
+    # Floating point results that happen to be whole or exactly representable go back
+    # to `Fraction` so later arithmetic stays exact.
+    if isinstance(value, complex):
+        raise UnsupportedExpression("Result is not a real number")
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise UnsupportedExpression("Result is not finite")
+        if value.is_integer():
+            return Fraction(int(value))
+    return value
+
+
+def _float_op(func, *args):
+    # Floating point math on exact values can overflow, either in the operation itself
+    # ("e^1000") or when a huge `Fraction` is converted ("ln(10^400)").
+    try:
+        return func(*(float(arg) for arg in args))
+    except OverflowError as e:
+        raise UnsupportedExpression("Result is too large") from e
+
+
+def _power(base, exponent):
+    exponent = _constant_value(exponent)
+    if isinstance(exponent, Fraction) and exponent.denominator == 1:
+        n = int(exponent)
+        if abs(n) > MAX_EXPONENT:
+            raise UnsupportedExpression("Exponent is too large")
+        if _variables(base):
+            if n < 0 or n > MAX_POLYNOMIAL_DEGREE:
+                raise UnsupportedExpression("Unsupported power of a variable")
+            out = _const(Fraction(1))
+            for _ in range(n):
+                out = _mul(out, base)
+            return out
+        value = _constant_value(base)
+        if value == 0 and n < 0:
+            raise UnsupportedExpression("Division by zero")
+        if isinstance(value, Fraction):
+            bits = max(value.numerator.bit_length(), value.denominator.bit_length())
+            if bits * abs(n) > MAX_RESULT_BITS:
+                raise UnsupportedExpression("Result is too large")
+        return _const(_real(_float_op(pow, value, n) if isinstance(value, float) else value ** n))
+    value = _constant_value(base)
+    if value < 0:
+        raise UnsupportedExpression("Result is not a real number")
+    return _const(_real(_float_op(pow, value, exponent)))
+
+
+# --- Parsing ---
+
+def normalize(text: str, known_names) -> str:
+    """
+    Rewrites handwritten math notation as a Python expression.
+
+    Maps symbols like "×" and "^" onto operators, splits juxtaposed single-letter
+    variables ("xy" becomes "x*y") and inserts the implicit multiplication in "2x",
+    "3(x + 1)" and "(a)(b)".
+    """
+    for symbol, replacement in _REPLACEMENTS.items():
+        text = text.replace(symbol, replacement)
+
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise UnsupportedExpression(f"Unexpected character {text[position]!r}")
+        number, name, operator = match.groups()
+        position = match.end()
+        if number is not None:
+            tokens.append(("num", number))
+        elif operator is not None:
+            tokens.append(("op", operator))
+        elif name in FUNCTIONS:
+            tokens.append(("func", name))
+        elif name in CONSTANTS or name in known_names or len(name) == 1:
+            tokens.append(("name", name))
+        elif name.isalpha():
+            tokens.extend(("name", letter) for letter in name)
+        else:
+            raise UnsupportedExpression(f"Unknown name {name!r}")
+
+    out = []
+    previous = None
+    for kind, value in tokens:
+        if previous is not None:
+            ends_operand = previous[0] in ("num", "name") or previous[1] == ")"
+            starts_operand = kind in ("num", "name", "func") or value == "("
+            if ends_operand and starts_operand:
+                out.append("*")
+        out.append(value)
+        previous = (kind, value)
+    return "".join(out)
+
+
+def _is_variable(name: str, known_names) -> bool:
+    """
+    Whether `name` is read as one variable, the way `normalize` reads it: a single letter
+    or an already known variable. "xy" is "x*y" on either side of an "=".
+    """
+    if name in CONSTANTS or name in FUNCTIONS:
+        return False
+    return (len(name) == 1 and name.isalpha()) or name in known_names
+
+
+def _parse(text: str, known_names):
+    try:
+        return ast.parse(normalize(text, known_names), mode="eval").body
+    except SyntaxError as e:
+        raise UnsupportedExpression(f"Could not parse {text!r}") from e
+
+
+def _to_fraction(value):
+    if isinstance(value, bool):
+        raise UnsupportedExpression("Boolean variables are not supported")
+    if isinstance(value, (int, Fraction)):
+        return Fraction(value)
+    try:
+        return _real(Fraction(str(value).strip()))
+    except (TypeError, ValueError) as e:
+        raise UnsupportedExpression(f"Variable value {value!r} is not a number") from e
+
+
+def _evaluate(node, variables):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        # Re-read the literal from its digits so "0.1" becomes exactly 1/10.
+        return _const(Fraction(repr(node.value)) if isinstance(node.value, float) else Fraction(node.value))
+    if isinstance(node, ast.Name):
+        if node.id in variables:
+            return _const(variables[node.id])
+        if node.id in CONSTANTS:
+            return _const(CONSTANTS[node.id])
+        return {((node.id, 1),): Fraction(1)}
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        operand = _evaluate(node.operand, variables)
+        return operand if isinstance(node.op, ast.UAdd) else _add({}, operand, -1)
+    if isinstance(node, ast.BinOp):
+        left = _evaluate(node.left, variables)
+        right = _evaluate(node.right, variables)
+        if isinstance(node.op, ast.Add):
+            return _add(left, right)
+        if isinstance(node.op, ast.Sub):
+            return _add(left, right, -1)
+        if isinstance(node.op, ast.Mult):
+            return _mul(left, right)
+        if isinstance(node.op, ast.Pow):
+            return _power(left, right)
+        if isinstance(node.op, (ast.Div, ast.Mod)):
+            divisor = _constant_value(right)
+            if divisor == 0:
+                raise UnsupportedExpression("Division by zero")
+            if isinstance(node.op, ast.Div):
+                return _mul(left, _const(1 / Fraction(divisor) if isinstance(divisor, Fraction) else 1 / divisor))
+            return _const(_constant_value(left) % divisor)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+        if len(node.args) != 1 or node.keywords:
+            raise UnsupportedExpression(f"{node.func.id}() takes exactly one argument")
+        argument = _constant_value(_evaluate(node.args[0], variables))
+        if isinstance(argument, Fraction) and node.func.id == "abs":
+            return _const(abs(argument))
+        try:
+            return _const(_real(_float_op(FUNCTIONS[node.func.id], argument)))
+        except UnsupportedExpression:
+            raise
+        except ValueError as e:
+            raise UnsupportedExpression(f"{node.func.id}() is undefined here") from e
+    raise UnsupportedExpression(f"Unsupported syntax: {ast.dump(node)}")
+
+
+# --- Solving ---
+
+def _solve_linear(equations, unknowns):
+    # Gauss-Jordan elimination over exact fractions. Each row is the coefficients of
+    # `unknowns` followed by the right-hand side.
+    rows = []
+    for poly in equations:
+        rows.append([poly.get(((var, 1),), Fraction(0)) for var in unknowns] + [-poly.get((), Fraction(0))])
+
+    size = len(unknowns)
+    for column in range(size):
+        pivot = next((r for r in range(column, len(rows)) if rows[r][column] != 0), None)
+        if pivot is None:
+            raise UnsupportedExpression("The system has no unique solution")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        pivot_value = rows[column][column]
+        rows[column] = [value / pivot_value for value in rows[column]]
+        for r in range(len(rows)):
+            if r != column and rows[r][column] != 0:
+                factor = rows[r][column]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[column])]
+
+    # Any extra equations must now read "0 = 0", or the system is inconsistent.
+    for row in rows[size:]:
+        if row[-1] != 0:
+            raise UnsupportedExpression("The system has no solution")
+    return {var: rows[i][-1] for i, var in enumerate(unknowns)}
+
+
+def _exact_sqrt(value):
+    if isinstance(value, Fraction) and value >= 0:
+        numerator, denominator = math.isqrt(value.numerator), math.isqrt(value.denominator)
+        if numerator * numerator == value.numerator and denominator * denominator == value.denominator:
+            return Fraction(numerator, denominator)
+    return math.sqrt(value)
+
+
+def _solve_quadratic(poly, var):
+    a = poly.get(((var, 2),), Fraction(0))
+    b = poly.get(((var, 1),), Fraction(0))
+    c = poly.get((), Fraction(0))
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        raise UnsupportedExpression("The equation has no real solutions")
+    root = _exact_sqrt(discriminant)
+    roots = {(-b + root) / (2 * a), (-b - root) / (2 * a)}
+    return sorted(_real(r) for r in roots)
+
+
+def format_number(value):
+    """Turns an internal number into an `int` or `float` suitable for JSON."""
+    if isinstance(value, Fraction):
+        if value.denominator != 1:
+            return _float_op(float, value)
+        # Python refuses to print integers this long, so they can't be sent as JSON.
+        if abs(value.numerator) >= 10 ** MAX_RESULT_DIGITS:
+            raise UnsupportedExpression("Result is too large")
+        return int(value)
+    if isinstance(value, float):
+        # Floats can still have overflowed to infinity, which isn't valid JSON.
+        if not math.isfinite(value):
+            raise UnsupportedExpression("Result is not finite")
+        return round(value, 10)
+    return value
+
+
+def _solve_system(equations):
+    polys = [poly for poly in equations if poly]
+    unknowns = sorted(set().union(*(_variables(poly) for poly in polys)))
+    if not unknowns:
+        raise UnsupportedExpression("The equation has no unknowns")
+    if len(unknowns) > MAX_UNKNOWNS:
+        raise UnsupportedExpression("The system has too many unknowns")
+    degree = max(_degree(poly) for poly in polys)
+
+    if degree == 1 and len(polys) >= len(unknowns):
+        solution = _solve_linear(polys, unknowns)
+        return [{"expr": var, "result": format_number(solution[var]), "assign": True} for var in unknowns]
+
+    if degree == 2 and len(polys) == 1 and len(unknowns) == 1:
+        var = unknowns[0]
+        roots = _solve_quadratic(polys[0], var)
+        if len(roots) == 1:
+            return [{"expr": var, "result": format_number(roots[0]), "assign": True}]
+        # Two roots can't be stored as one variable, so report them without assigning.
+        return [{"expr": var, "result": ", ".join(str(format_number(r)) for r in roots), "assign": False}]
+
+    raise UnsupportedExpression("Only linear systems and single-variable quadratics are supported")
+
+
+def _guard_overflow(func):
+    # Mixed float and `Fraction` arithmetic converts the `Fraction` to a float, which can
+    # overflow anywhere in an expression ("pi * 10^400"). Those are unsupported too.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OverflowError as e:
+            raise UnsupportedExpression("Result is too large") from e
+    return wrapper
+
+
+@_guard_overflow
+def solve_text(text: str, dict_of_vars: dict) -> list:
+    """
+    Solves one or more statements (separated by newlines or ";") without calling the model.
+
+    - "2 + 3 * 4" evaluates to `{'expr': '2 + 3 * 4', 'result': 14, 'assign': False}`.
+    - "x = 4" assigns: `{'expr': 'x', 'result': 4, 'assign': True}`. Later statements see it.
+    - Any other statement containing "=" is an equation. All equations are solved together
+      as one system, with one assigned dict per unknown.
+
+    Raises `UnsupportedExpression` if any statement can't be handled locally.
+    """
+    statements = [s.strip() for s in re.split(r"[;\n]", text) if s.strip()]
+    if not statements:
+        raise UnsupportedExpression("No expression given")
+
+    # Variables whose value isn't a number (e.g. a stored abstract-concept answer) are
+    # left out, so using one makes the statement unsupported rather than wrong.
+    variables = {}
+    for name, value in dict_of_vars.items():
+        try:
+            variables[name] = _to_fraction(value)
+        except UnsupportedExpression:
+            pass
+    results = []
+    equations = []
+    system_index = None
+
+    for statement in statements:
+        sides = statement.split("=")
+        if len(sides) > 2:
+            raise UnsupportedExpression(f"Chained equality in {statement!r}")
+        if len(sides) == 1:
+            value = _constant_value(_evaluate(_parse(statement, variables), variables))
+            results.append({"expr": statement, "result": format_number(value), "assign": False})
+            continue
+
+        left, right = (side.strip() for side in sides)
+        if _is_variable(left, variables):
+            right_poly = _evaluate(_parse(right, variables), variables)
+            if not _variables(right_poly):
+                value = _constant_value(right_poly)
+                variables[left] = value
+                results.append({"expr": left, "result": format_number(value), "assign": True})
+                continue
+
+        # An equation: remember where the system's answers go, solve them all at the end.
+        if system_index is None:
+            system_index = len(results)
+        lhs = _evaluate(_parse(left, variables), variables)
+        rhs = _evaluate(_parse(right, variables), variables)
+        equations.append(_add(lhs, rhs, -1))
+
+    if equations:
+        results[system_index:system_index] = _solve_system(equations)
+    return results
+
+
+
+@_guard_overflow
+def evaluate_arithmetic(text: str):
+    """Evaluates a single arithmetic expression with no variables, e.g. "12*3+4"."""
+    return format_number(_constant_value(_evaluate(_parse(text, ()), {})))
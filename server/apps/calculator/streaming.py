@@ -0,0 +1,59 @@
+# This file pulls result dicts out of a model response while it is still being streamed.
+#
+# The model answers with a list of dicts, e.g. "[{'expr': '2 + 2', 'result': 4}, ...]".
+# Waiting for the closing "]" means waiting for the whole completion. Instead, the
+# `IncrementalDictParser` below is fed each chunk of text as it arrives and hands back
+# every dict as soon as its closing "}" has been seen, so the first answer can be shown
+# to the user while the model is still writing the rest.
+#
+# The parser only tracks brace depth and whether it is inside a quoted string, so each
+# character is looked at once no matter how the text is split into chunks.
+
+from .parser import parse_answers
+
+
+def parse_dict_literal(text: str):
+    """Parses a single `{...}` with the same tolerant parser used for whole responses."""
+    answers = parse_answers(text).answers
+    return answers[0] if answers else None
+
+
+class IncrementalDictParser:
+    def __init__(self):
+        self.text = ""
+        self._position = 0    # How far into `text` we've scanned.
+        self._depth = 0       # Current `{` nesting depth.
+        self._start = None    # Where the current top-level dict began.
+        self._quote = None    # The quote character of the string we're inside, if any.
+        self._escaped = False
+
+    def feed(self, chunk: str) -> list:
+        """Adds `chunk` to the text and returns the dicts it completed."""
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._position, len(text)):
+            char = text[i]
+            if self._quote is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+            elif char in ("'", '"'):
+                if self._depth > 0:
+                    self._quote = char
+            elif char == "{":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    value = parse_dict_literal(text[self._start:i + 1])
+                    if value is not None:
+                        completed.append(value)
+                    self._start = None
+        self._position = len(text)
+        return completed
@@ -0,0 +1,176 @@
+# This file reads and decodes the raw image uploads of `/calculate/upload`.
+#
+# The JSON endpoint receives the canvas as a base64 data URL inside a JSON string. That
+# costs a third more bytes on the wire, a JSON parse of a multi-megabyte string, a
+# base64 decode into a new buffer and a `BytesIO` copy before PIL sees any pixels. Here
+# the request body *is* the image: it is read once into a single preallocated buffer
+# and decoded straight from a `memoryview` of that buffer.
+#
+# Supported bodies (chosen by the Content-Type header):
+# - `image/png`, `image/webp` (or `application/octet-stream`, sniffed by PIL).
+# - `application/x-canvas-rle`: a run-length encoded canvas, which is far smaller than a
+#   PNG for a mostly empty drawing and decodes with a few NumPy operations:
+#
+#       magic    4 bytes   b"CRL1"
+#       width    uint16    little-endian
+#       height   uint16    little-endian
+#       colors   uint8     number of palette entries (1 to 255)
+#       palette  colors x 4 bytes, RGBA
+#       runs     (uint16 length, uint8 palette index) pairs, row-major, covering
+#                exactly width x height pixels. Longer runs are split.
+
+import io
+
+import numpy as np
+from PIL import Image
+
+from metrics import span
+
+IMAGE_TYPES = {"image/png", "image/webp", "application/octet-stream"}
+# Only these decoders are tried, whatever the body claims to be.
+UPLOAD_FORMATS = ["PNG", "WEBP"]
+RLE_TYPE = "application/x-canvas-rle"
+RLE_MAGIC = b"CRL1"
+RLE_RUN = np.dtype([("length", "<u2"), ("color", "u1")])
+# A few bytes of runs can describe a huge canvas, so the decoded size is capped
+# (4096 x 4096 RGBA is 64 MiB).
+RLE_MAX_PIXELS = 4096 * 4096
+
+
+class UploadTooLarge(Exception):
+    """Raised when the request body is bigger than the configured limit."""
+
+
+class UnsupportedUpload(ValueError):
+    """Raised for a content type this endpoint doesn't accept."""
+
+
+class InvalidUpload(ValueError):
+    """Raised when the body can't be decoded as the declared type."""
+
+
+async def read_body(request, limit: int) -> memoryview:
+    """
+    Reads the request body into one buffer and returns a view of it.
+
+    When the client sends a Content-Length the buffer is allocated once at that size and
+    every chunk is copied straight into place; otherwise it grows as chunks arrive. Either
+    way reading stops as soon as the body passes `limit`.
+    """
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit():
+        if int(declared) > limit:
+            raise UploadTooLarge(f"Upload is {declared} bytes; the limit is {limit}")
+        buffer = bytearray(int(declared))
+    else:
+        buffer = bytearray()
+
+    size = 0
+    view = memoryview(buffer)
+    async for chunk in request.stream():
+        end = size + len(chunk)
+        if end > limit:
+            raise UploadTooLarge(f"Upload is over the limit of {limit} bytes")
+        if end <= len(buffer):
+            view[size:end] = chunk
+        else:
+            # The client sent more than it declared (or declared nothing).
+            view.release()
+            buffer[size:] = chunk
+            view = memoryview(buffer)
+        size = end
+    return view[:size]
+
+
+class MemoryReader(io.RawIOBase):
+    """A read-only, seekable file over a memoryview, so PIL can decode without a copy."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        count = max(min(len(target), len(self._view) - self._position), 0)
+        target[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def decode_rle(view: memoryview) -> Image.Image:
+    header = 9
+    if len(view) < header or bytes(view[:4]) != RLE_MAGIC:
+        raise InvalidUpload("Not a canvas RLE image")
+    width = int.from_bytes(view[4:6], "little")
+    height = int.from_bytes(view[6:8], "little")
+    colors = view[8]
+    if not 0 < width * height <= RLE_MAX_PIXELS:
+        raise InvalidUpload(f"Canvas RLE size {width}x{height} is out of range")
+    runs_start = header + 4 * colors
+    if colors == 0 or (len(view) - runs_start) % RLE_RUN.itemsize or len(view) < runs_start:
+        raise InvalidUpload("Malformed canvas RLE image")
+
+    # Each RGBA palette entry read as one 32-bit word, so every pixel is a single copy.
+    palette = np.frombuffer(view, dtype=np.uint32, count=colors, offset=header)
+    runs = np.frombuffer(view, dtype=RLE_RUN, offset=runs_start)
+    if int(runs["length"].sum(dtype=np.int64)) != width * height:
+        raise InvalidUpload("Canvas RLE runs don't cover the image")
+    if runs.size and int(runs["color"].max()) >= colors:
+        raise InvalidUpload("Canvas RLE run refers to a missing color")
+
+    pixels = np.repeat(palette[runs["color"]], runs["length"])
+    return Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+
+
+def encode_rle(img: Image.Image) -> bytes:
+    """Encodes an image in the canvas RLE format (the inverse of `decode_rle`)."""
+    pixels = np.ascontiguousarray(img.convert("RGBA")).view(np.uint32).reshape(-1)
+    palette, indices = np.unique(pixels, return_inverse=True)
+    if len(palette) > 255:
+        raise InvalidUpload("Canvas RLE supports at most 255 colors")
+    indices = indices.reshape(-1).astype(np.uint8)
+    # Start a new run wherever the color changes, and split runs longer than 65535.
+    starts = np.flatnonzero(np.diff(indices, prepend=np.int16(-1)))
+    lengths = np.diff(np.append(starts, indices.size))
+    pieces = -(-lengths // 0xFFFF)
+    run_starts = np.repeat(starts, pieces) + 0xFFFF * (
+        np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    )
+    runs = np.empty(run_starts.size, dtype=RLE_RUN)
+    runs["length"] = np.diff(np.append(run_starts, indices.size))
+    runs["color"] = indices[run_starts]
+    header = RLE_MAGIC + img.width.to_bytes(2, "little") + img.height.to_bytes(2, "little") + bytes([len(palette)])
+    return header + palette.tobytes() + runs.tobytes()
+
+
+def decode_upload(view: memoryview, content_type: str) -> Image.Image:
+    """Decodes an uploaded body into a PIL image, without copying the body first."""
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    if content_type == RLE_TYPE:
+        with span("rle_decode"):
+            return decode_rle(view)
+    if content_type not in IMAGE_TYPES:
+        raise UnsupportedUpload(f"Unsupported content type {content_type!r}")
+    with span("pil_open"):
+        try:
+            image = Image.open(MemoryReader(view), formats=UPLOAD_FORMATS)
+            image.load()
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            raise InvalidUpload(f"Could not decode image: {e}")
+    return image
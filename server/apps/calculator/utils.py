@@ -1,125 +1,300 @@
-import ast
-import json
+import asyncio
+import copy
+import logging
 import re
 import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
-from groq import Groq
-from constants import GROQ_API_KEY
-
-client = Groq(api_key=GROQ_API_KEY)
-
-def analyze(img: Image, dict_of_vars: dict):
-    # dumping the dict of vars into a json string for passing into the prompt
-    dict_of_vars_json = json.dumps(dict_of_vars)
-
-    prompt = (
-         f"You have been given an image with some mathematical expressions, equations, or graphical problems, and you need to solve them. "
-        f"Note: Use the PEMDAS rule for solving mathematical expressions. PEMDAS stands for the Priority Order: Parentheses, Exponents, Multiplication and Division (from left to right), Addition and Subtraction (from left to right). Parentheses have the highest priority, followed by Exponents, then Multiplication and Division, and lastly Addition and Subtraction. "
-        f"For example: "
-        f"Q. 2 + 3 * 4 "
-        f"(3 * 4) => 12, 2 + 12 = 14. "
-        f"Q. 2 + 3 + 5 * 4 - 8 / 2 "
-        f"5 * 4 => 20, 8 / 2 => 4, 2 + 3 => 5, 5 + 20 => 25, 25 - 4 => 21. "
-        f"YOU CAN HAVE FIVE TYPES OF EQUATIONS/EXPRESSIONS IN THIS IMAGE, AND ONLY ONE CASE SHALL APPLY EVERY TIME: "
-        f"Following are the cases: "
-        f"1. Simple mathematical expressions like 2 + 2, 3 * 4, 5 / 6, 7 - 8, etc.: In this case, solve and return the answer in the format of a LIST OF ONE DICT [{{'expr': given expression, 'result': calculated answer}}]. "
-        f"2. Set of Equations like x^2 + 2x + 1 = 0, 3y + 4x = 0, 5x^2 + 6y + 7 = 12, etc.: In this case, solve for the given variable, and the format should be a COMMA SEPARATED LIST OF DICTS, with dict 1 as {{'expr': 'x', 'result': 2, 'assign': True}} and dict 2 as {{'expr': 'y', 'result': 5, 'assign': True}}. This example assumes x was calculated as 2, and y as 5. Include as many dicts as there are variables. "
-        f"3. Assigning values to variables like x = 4, y = 5, z = 6, etc.: In this case, assign values to variables and return another key in the dict called {{'assign': True}}, keeping the variable as 'expr' and the value as 'result' in the original dictionary. RETURN AS A LIST OF DICTS. "
-        f"4. Analyzing Graphical Math problems, which are word problems represented in drawing form, such as cars colliding, trigonometric problems, problems on the Pythagorean theorem, adding runs from a cricket wagon wheel, etc. These will have a drawing representing some scenario and accompanying information with the image. PAY CLOSE ATTENTION TO DIFFERENT COLORS FOR THESE PROBLEMS. You need to return the answer in the format of a LIST OF ONE DICT [{{'expr': given expression, 'result': calculated answer}}]. "
-        f"5. Detecting Abstract Concepts that a drawing might show, such as love, hate, jealousy, patriotism, or a historic reference to war, invention, discovery, quote, etc. USE THE SAME FORMAT AS OTHERS TO RETURN THE ANSWER, where 'expr' will be the explanation of the drawing, and 'result' will be the abstract concept. "
-        f"Analyze the equation or expression in this image and return the answer according to the given rules: "
-        f"Make sure to use extra backslashes for escape characters like \\f -> \\\\f, \\n -> \\\\n, etc. "
-        f"Here is a dictionary of user-assigned variables. If the given expression has any of these variables, use its actual value from this dictionary accordingly: {dict_of_vars_json}. "
-        f"DO NOT USE BACKTICKS OR MARKDOWN FORMATTING. "
-        f"PROPERLY QUOTE THE KEYS AND VALUES IN THE DICTIONARY FOR EASIER PARSING WITH Python's ast.literal_eval."
-    )
-    
-    # Convert PIL image to base64
-    # JPEG does not support transparency (RGBA). If the canvas image has an alpha
-    # channel (which it does), we composite it onto a white background first.
-    buffered = BytesIO()
-    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-        background = Image.new("RGB", img.size, (255, 255, 255))
-        background.paste(img, mask=img.split()[-1])  # Use alpha channel as mask
-        img_to_encode = background
-    else:
-        img_to_encode = img.convert("RGB")
-    img_to_encode.save(buffered, format="JPEG", quality=90)
-    base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    response_text = ""
+import httpx
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+from constants import (
+    GROQ_API_KEY, GROQ_WORKER_CONCURRENCY, GROQ_MAX_QUEUE, IMAGE_WORKERS, UPSTREAM_KEEPALIVE,
+    GROQ_MODEL, GROQ_SIMPLE_MODEL, GROQ_FALLBACK_MODEL, UPSTREAM_MAX_RETRIES, RETRY_BUDGET_RATIO,
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY, RATE_LIMIT_MAX_WAIT, BREAKER_FAILURES, BREAKER_COOLDOWN,
+    RESULT_CACHE_BACKEND, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_PATH,
+    PREPROCESS_MAX_DIM, PREPROCESS_PADDING, ANALYZE_MODE, ANALYZER, LOCAL_MIN_CONFIDENCE, BATCH_IMAGES_PER_CALL,
+    REGION_CELL_SIZE, SESSION_BACKEND, SESSION_MAX_BYTES, SESSION_TTL, SESSION_PATH, WORKERS,
+)
+from logging_config import SAMPLED
+from metrics import Counter, ERRORS, Gauge, SESSION_REGIONS, STAGE_SECONDS, record_usage, span
+from .analyzer import Analyzer, LocalAnalyzer, build_analyzer
+from .cache import build_result_cache, cache_key
+from .preprocess import encode_prepared, prepare_image, rasterize_strokes
+from .recognizer import recognize_once
+from .prompts import TRANSCRIBE_PROMPT, Prompt, build_batch_prompt, build_prompt
+from .gateway import RetryBudget, UpstreamGateway
+from .limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, UpstreamBusy, UpstreamLimiter
+from .session import assignments, build_session_store, compose_regions, plan, segment
+from .singleflight import SingleFlight
+from .parser import parse_answers
+from .solver import UnsupportedExpression, evaluate_arithmetic, solve_text
+from .streaming import IncrementalDictParser
+
+# The async client lets the event loop serve other requests while a vision call is in
+# flight. All upstream calls go through `gateway`, which takes a slot from `limiter` (a cap
+# on how many run at once), stays within Groq's rate limits and retries failed calls; see
+# `gateway.py`. The client is created on first use (normally by `lifecycle.startup()`),
+# so importing this module doesn't need an API key.
+client = None
+limiter = UpstreamLimiter(GROQ_WORKER_CONCURRENCY, GROQ_MAX_QUEUE)
+gateway = UpstreamGateway(
+    limiter,
+    lambda: upstream_client(),
+    max_retries=UPSTREAM_MAX_RETRIES,
+    retry_budget=RetryBudget(RETRY_BUDGET_RATIO, reserve=max(UPSTREAM_MAX_RETRIES, 1) * 3),
+    base_delay=RETRY_BASE_DELAY,
+    max_delay=RETRY_MAX_DELAY,
+    max_rate_wait=RATE_LIMIT_MAX_WAIT,
+    breaker_threshold=BREAKER_FAILURES,
+    breaker_cooldown=BREAKER_COOLDOWN,
+    fallback_model=GROQ_FALLBACK_MODEL,
+    # Each worker paces itself to its share of the account's rate limits.
+    rate_share=1 / WORKERS,
+)
+
+# CPU-bound image work (decoding, compositing, JPEG encoding) runs on this pool so it
+# never blocks the event loop thread.
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Calls to SQLite-backed stores (file I/O, and waits for other workers' write locks) run
+# on their own small pool, so they neither block the event loop nor queue behind images.
+store_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="store")
+
+# Answers keyed on the image sent upstream plus the variables. `None` when disabled.
+result_cache = build_result_cache(RESULT_CACHE_BACKEND, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_PATH)
+
+# Identical upstream calls that overlap in time are made once; see `singleflight.py`.
+flights = SingleFlight()
+
+# What each drawing session has already solved; see `session.py`.
+sessions = build_session_store(SESSION_BACKEND, SESSION_MAX_BYTES, SESSION_TTL, SESSION_PATH)
+
+logger = logging.getLogger(__name__)
+
+BATCH_FALLBACKS = Counter(
+    "calc_batch_fallbacks_total", "Batch images re-solved alone because the model didn't number their answers."
+)
+
+# These are read from the limiter, single-flight and the cache each time `/metrics` is scraped.
+Gauge("calc_upstream_in_flight", "Upstream calls currently running.", function=lambda: limiter.in_flight)
+Gauge("calc_upstream_waiting", "Requests waiting for a free upstream slot.", function=lambda: limiter.waiting)
+Counter("calc_coalesced_total", "Requests that joined an identical upstream call in flight.", function=lambda: flights.coalesced)
+Counter("calc_coalesce_abandoned_total", "Shared upstream calls cancelled after every waiter left.", function=lambda: flights.abandoned)
+Gauge("calc_coalesce_in_flight", "Distinct upstream calls currently shared through single-flight.", function=lambda: flights.in_flight)
+Counter("calc_cache_hits_total", "Result cache hits.", function=lambda: result_cache.hits if result_cache else 0)
+Counter("calc_cache_misses_total", "Result cache misses.", function=lambda: result_cache.misses if result_cache else 0)
+Gauge("calc_cache_entries", "Entries in the result cache.", function=lambda: len(result_cache.backend) if result_cache else 0)
+Gauge("calc_sessions", "Drawing sessions currently remembered.", function=lambda: len(sessions))
+Gauge("calc_retry_budget", "Retries the upstream retry budget currently allows.", function=lambda: gateway.retry_budget.balance)
+Gauge("calc_rate_limit_requests_available", "Groq requests left in the current rate limit window (-1 until known).",
+      function=lambda: gateway.requests.level if gateway.requests.capacity is not None else -1)
+Gauge("calc_rate_limit_tokens_available", "Groq tokens left in the current rate limit window (-1 until known).",
+      function=lambda: gateway.tokens.level if gateway.tokens.capacity is not None else -1)
+
+
+def upstream_client() -> AsyncGroq:
+    global client
+    if client is None:
+        # One pooled connection per upstream slot, kept open long enough to be reused
+        # between bursts (httpx's default is to close them after 5 idle seconds).
+        limits = httpx.Limits(
+            max_connections=GROQ_WORKER_CONCURRENCY,
+            max_keepalive_connections=GROQ_WORKER_CONCURRENCY,
+            keepalive_expiry=UPSTREAM_KEEPALIVE,
+        )
+        # Retries are made by the gateway, within its retry budget, not by the SDK.
+        client = AsyncGroq(
+            api_key=GROQ_API_KEY, max_retries=0, http_client=DefaultAsyncHttpxClient(limits=limits)
+        )
+    return client
+
+
+async def run_in_store_executor(store, func, *args):
+    # `store` is the result cache or the session store; in-memory ones answer right away.
+    if not store.backend.blocking:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(store_executor, func, *args)
+
+
+async def run_in_image_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, func, *args)
+
+
+def decode_data_url(image_data_url: str) -> Image.Image:
+    # Strip the "data:image/png;base64," header and let PIL decode the rest. `load()`
+    # forces the actual decode here, on the executor thread, instead of lazily later.
+    with span("base64_decode"):
+        header, encoded = image_data_url.split(",", 1)
+        image_data = base64.b64decode(encoded)
+    with span("pil_open"):
+        image = Image.open(BytesIO(image_data))
+        image.load()
+    return image
+
+
+def fingerprint(prepared: Image.Image) -> bytes:
+    # Mode and size are part of the fingerprint so equal pixel bytes of differently
+    # shaped images can't collide.
+    header = f"{prepared.mode}:{prepared.width}x{prepared.height}:".encode("ascii")
+    return header + prepared.tobytes()
+
+
+def prepare_for_upstream(img: Image.Image):
+    # Crop, flatten and downscale the canvas, then fingerprint the result for the cache.
+    with span("preprocess"):
+        prepared = prepare_image(img, PREPROCESS_MAX_DIM, PREPROCESS_PADDING)
+    if prepared is None:
+        return None, None
+    return prepared, fingerprint(prepared)
+
+
+def rasterize_for_upstream(strokes: list):
+    # Vector strokes are drawn already cropped and scaled, so there is no ink to find.
+    with span("rasterize"):
+        prepared = rasterize_strokes(strokes, PREPROCESS_MAX_DIM, PREPROCESS_PADDING)
+    if prepared is None:
+        return None, None
+    return prepared, fingerprint(prepared)
+
+
+def encode_for_upstream(prepared: Image.Image):
+    with span("encode"):
+        return encode_prepared(prepared)
+
+
+def encode_and_route(prepared: Image.Image):
+    """
+    Encodes `prepared` and picks the model and prompt template for it.
+    Returns `(image, model, template)`.
+    """
+    image = encode_for_upstream(prepared)
+    # Plain written math gets the simple tier and the shorter "written" prompt. Anything
+    # else keeps the full prompt, with its drawing and abstract-concept cases.
+    with span("classify"):
+        written = reads_as_written_math(prepared)
+    if written:
+        return image, GROQ_SIMPLE_MODEL, "written"
+    return image, GROQ_MODEL, "full"
+
+
+def reads_as_written_math(prepared: Image.Image) -> bool:
+    """
+    Whether the local recognizer confidently reads `prepared` as plain written math.
+
+    Only then does a drawing skip the larger model and the full prompt. The shape of the
+    ink alone isn't enough: a sketched arrow, car or triangle is as wide and flat as
+    "12 + 7 =". In "auto" mode the local analyzer has already read the drawing, and its
+    reading is reused. A drawing the recognizer fails on gets the full prompt.
+    """
     try:
-        # Using Llama 4 Scout — Groq's current supported multimodal vision model.
-        # Supports base64 encoded images up to 4MB, max 5 images per request.
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
+        recognized = recognize_once(prepared)
+    except Exception:
+        logger.warning("Local recognizer failed while routing", exc_info=True)
+        return False
+    return recognized is not None and recognized[1] >= LOCAL_MIN_CONFIDENCE
+
+
+def build_messages(prompt: str, images: list) -> list:
+    # `images` is a list of `(mime_type, base64_data)` pairs, as returned by `encode_prepared`.
+    return [
+        {
+            "role": "user",
+            "content": [{"type": "text", "text": prompt}] + [
                 {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{base64_image}"
+                    }
                 }
-            ],
-            temperature=0.1,
-            max_completion_tokens=1024
-        )
-        response_text = completion.choices[0].message.content
-        print(response_text)
-    except Exception as e:
-        print(f"Error calling Groq: {e}")
-        return [{"expr": "Groq Error", "result": str(e), "assign": False}]
+                for mime_type, base64_image in images
+            ]
+        }
+    ]
 
-    answers = []
-    
+
+# Roughly what Groq counts for one of our prepared images, for `estimate_tokens`.
+IMAGE_TOKEN_ESTIMATE = 1000
+
+
+def estimate_tokens(prompt: Prompt, images: list, max_completion_tokens: int) -> int:
+    # A rough upper bound for the rate limit budget: about 4 characters per prompt token,
+    # a flat cost per image, and the full completion. The gateway corrects its budget
+    # from Groq's headers after every call, so this only has to be in the right range.
+    return len(prompt.text) // 4 + IMAGE_TOKEN_ESTIMATE * len(images) + max_completion_tokens
+
+
+async def complete(prompt: Prompt, images: list, max_completion_tokens: int,
+                   model: str = GROQ_MODEL, priority: int = PRIORITY_INTERACTIVE) -> str:
+    # Waiting for a free upstream slot or for the rate limit budget can raise
+    # `UpstreamBusy`, which the route turns into a 503 rather than a result.
+    # The default model is Llama 4 Scout, Groq's current multimodal vision model. It
+    # supports base64 encoded images up to 4MB, max 5 images per request.
+    completion, _ = await gateway.create(
+        model,
+        estimate_tokens(prompt, images, max_completion_tokens),
+        priority,
+        messages=build_messages(prompt.text, images),
+        temperature=0.1,
+        max_completion_tokens=max_completion_tokens
+    )
+    record_usage(completion.usage, prompt.name)
+    return completion.choices[0].message.content
+
+
+async def complete_stream(prompt: Prompt, images: list, max_completion_tokens: int, model: str = GROQ_MODEL):
+    """Like `complete`, but yields the response text piece by piece as Groq produces it."""
+    stream = gateway.stream(
+        model,
+        estimate_tokens(prompt, images, max_completion_tokens),
+        messages=build_messages(prompt.text, images),
+        temperature=0.1,
+        max_completion_tokens=max_completion_tokens
+    )
+    # Time to first token (including any wait for a slot), which prompt size drives.
+    start = time.perf_counter()
+    first_token = True
+    # If the client goes away mid-stream, this generator is closed, and closing the
+    # gateway's stream releases the upstream connection (and the limiter slot).
     try:
-        # First try direct ast.literal_eval
-        answers = ast.literal_eval(response_text)
-    except Exception as e:
-        print(f"Error in direct parsing: {e}")
-        
-        try:
-            # Try to extract JSON from the response
-            # Look for JSON pattern in the response
-            json_match = re.search(r'\[\s*\{.*\}\s*\]', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                # Replace single quotes with double quotes for proper JSON
-                json_str = json_str.replace("'", '"')
-                answers = json.loads(json_str)
-                print(f"Extracted JSON: {json_str}")
-            else:
-                # Try to extract key information directly
-                expr_match = re.search(r"expr[\'\"]\s*:\s*[\'\"](.*?)[\'\"]", response_text)
-                result_match = re.search(r"result[\'\"]\s*:\s*([\'\"]?.*?[\'\"]?)[,}]", response_text)
-                
-                if expr_match and result_match:
-                    expr = expr_match.group(1)
-                    result_str = result_match.group(1).strip('\'"')
-                    
-                    # Try to convert result to number if possible
-                    try:
-                        result = int(result_str)
-                    except ValueError:
-                        try:
-                            result = float(result_str)
-                        except ValueError:
-                            result = result_str
-                            
-                    answers = [{"expr": expr, "result": result}]
-                    print(f"Extracted expression: {expr}, result: {result}")
-        except Exception as nested_e:
-            print(f"Error in alternative parsing: {nested_e}")
-    
-    print('returned answer ', answers)
-    
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token:
+                    first_token = False
+                    STAGE_SECONDS.observe(time.perf_counter() - start, stage="first_token")
+                yield chunk.choices[0].delta.content
+            # Groq reports token usage on the final chunk, under `x_groq`.
+            x_groq = getattr(chunk, "x_groq", None)
+            record_usage(getattr(chunk, "usage", None) or getattr(x_groq, "usage", None), prompt.name)
+    finally:
+        await stream.aclose()
+
+
+async def transcribe_and_solve(image: tuple, dict_of_vars: dict, model: str = GROQ_MODEL):
+    # A transcription needs a few dozen output tokens instead of a worked answer, and
+    # the local solver gives exact results. Returns `None` when the drawing isn't
+    # something the solver handles, so the caller can fall back to the full prompt.
+    transcript = (await complete(TRANSCRIBE_PROMPT, [image], 128, model)).strip()
+    logger.debug("Transcription: %s", transcript)
+    if not transcript or transcript.upper().startswith("NONE"):
+        return None
+    try:
+        return await run_in_image_executor(solve_text, transcript, dict_of_vars)
+    except UnsupportedExpression as e:
+        logger.debug("Local solver declined: %s", e)
+        return None
+
+
+def parse_response(response_text: str) -> list:
+    with span("parse"):
+        parsed = parse_answers(response_text)
+    if parsed.diagnostics:
+        logger.info("Repaired model response: %s", parsed.diagnostics)
+    answers = parsed.answers
+
     # If we still have no answers, create a default one based on the response text
     if not answers:
         # Try to extract any mathematical expression from the response
@@ -127,15 +302,306 @@ def analyze(img: Image, dict_of_vars: dict):
         if math_expr:
             expr = math_expr.group(1)
             try:
-                # Safely evaluate the expression
-                result = eval(expr, {"__builtins__": {}})
-                answers = [{"expr": expr, "result": result}]
-            except:
+                # Evaluate with the local solver, which only understands arithmetic.
+                result = evaluate_arithmetic(expr)
+                answers = [{"expr": expr, "result": result, "assign": False}]
+            except UnsupportedExpression:
                 pass
-    
-    # Add assign field if missing
+
+    return answers
+
+
+class GroqAnalyzer(Analyzer):
+    """
+    Solves the drawing with the vision model. In "full" mode the model reads and solves
+    it in one call. In "transcribe" mode it only transcribes it and the local solver
+    computes the answer; anything the solver can't handle still gets the full prompt.
+    Never declines.
+    """
+
+    name = "groq"
+    remote = True
+
+    async def analyze(self, prepared: Image.Image, dict_of_vars: dict, mode: str):
+        # Only drawings that reach Groq pay for encoding.
+        image, model, template = await run_in_image_executor(encode_and_route, prepared)
+        answers = None
+        if mode == "transcribe":
+            answers = await transcribe_and_solve(image, dict_of_vars, model)
+        if answers is None:
+            response_text = await complete(build_prompt(dict_of_vars, template), [image], 1024, model)
+            logger.debug("Model response: %s", response_text, extra=SAMPLED)
+            answers = parse_response(response_text)
+        return answers
+
+
+# The analyzers asked for every drawing that isn't cached, picked by `ANALYZER`; see
+# `analyzer.py`.
+analyzer = build_analyzer(ANALYZER, GroqAnalyzer(), LocalAnalyzer(run_in_image_executor, LOCAL_MIN_CONFIDENCE))
+
+
+async def prepare_and_lookup(source, dict_of_vars: dict, prepare=prepare_for_upstream):
+    """
+    Prepares the canvas for upstream and checks the result cache. `source` is a canvas
+    image, or a list of strokes when `prepare` is `rasterize_for_upstream`.
+
+    Returns `(prepared_image, cache_key, cached_answers)`. `cached_answers` is not `None`
+    when the request can be answered without calling Groq.
+    """
+    # Crop the canvas down to the ink off the event loop. A blank canvas never
+    # reaches Groq; the route turns the empty list into "No expression detected".
+    prepared, image_fingerprint = await run_in_image_executor(prepare, source)
+    if prepared is None:
+        return None, None, []
+
+    # Same drawing, same variables: answer from the cache without calling Groq. The key
+    # is also what identical in-flight requests are coalesced on, so it's computed even
+    # when the cache is off.
+    key = cache_key(image_fingerprint, dict_of_vars)
+    if result_cache is not None:
+        with span("cache_lookup"):
+            cached = await run_in_store_executor(result_cache, result_cache.get, key)
+        if cached is not None:
+            return prepared, key, cached
+    return prepared, key, None
+
+
+async def analyze(img: Image, dict_of_vars: dict, mode: str = ANALYZE_MODE):
+    """
+    Solves the drawing in `img` with the analyzers picked by `ANALYZER`.
+
+    `mode` is how Groq is used. In "full" mode the model reads and solves the drawing in
+    one call. In "transcribe" mode it only transcribes it, and the local solver computes
+    the answer; word problems and anything else the solver can't handle still get the
+    full prompt.
+    """
+    prepared, key, cached = await prepare_and_lookup(img, dict_of_vars)
+    if cached is not None:
+        return cached
+    return await analyze_shared(prepared, key, dict_of_vars, mode)
+
+
+async def analyze_strokes(strokes: list, dict_of_vars: dict, mode: str = ANALYZE_MODE):
+    """
+    Solves a drawing sent as vector strokes, given as `(points, color, width)` tuples
+    (see `rasterize_strokes`). Otherwise the same as `analyze`.
+    """
+    prepared, key, cached = await prepare_and_lookup(strokes, dict_of_vars, rasterize_for_upstream)
+    if cached is not None:
+        return cached
+    return await analyze_shared(prepared, key, dict_of_vars, mode)
+
+
+async def analyze_incremental(img: Image, dict_of_vars: dict, session_id: str, mode: str = ANALYZE_MODE):
+    """
+    Solves the drawing in `img`, reusing what the same session solved before.
+
+    Only regions of the canvas that are new or changed since the session's previous
+    request are sent upstream, together with earlier regions whose answers didn't assign
+    a variable (see `session.py`). Returns the reused answers followed by the new ones.
+    """
+    regions = await run_in_image_executor(segment, img, REGION_CELL_SIZE)
+    stored = await run_in_store_executor(sessions, sessions.get, session_id, dict_of_vars)
+    kept, boxes, fingerprints = plan(stored, regions)
+    SESSION_REGIONS.inc(len(regions) - len(boxes), outcome="reused")
+    SESSION_REGIONS.inc(len(boxes), outcome="solved")
+    answers = [answer for group in kept for answer in group["answers"]]
+
+    if boxes:
+        # Nothing to reuse: the canvas is solved as is. Otherwise only the changed
+        # regions are drawn onto an empty canvas, and the variables assigned by the
+        # reused answers (e.g. "x = 4" further up) are passed along with it.
+        source = img if not kept else await run_in_image_executor(compose_regions, img, boxes)
+        new_answers = await analyze(source, {**dict_of_vars, **assignments(kept)}, mode)
+        # Failed or empty answers aren't remembered, so the next request tries again.
+        if not new_answers or any(answer.get("expr") == "Groq Error" for answer in new_answers):
+            return answers + new_answers
+        kept = kept + [{"regions": fingerprints, "answers": new_answers}]
+        answers += new_answers
+
+    await run_in_store_executor(sessions, sessions.set, session_id, dict_of_vars, kept)
+    return answers
+
+
+async def analyze_shared(prepared: Image.Image, key: str, dict_of_vars: dict, mode: str):
+    # Identical requests already waiting on Groq share that call instead of making their
+    # own. Joiners get a copy, since the route normalizes the answers in place.
+    answers, shared = await flights.do(
+        (mode, key), lambda: analyze_upstream(prepared, key, dict_of_vars, mode)
+    )
+    return copy.deepcopy(answers) if shared else answers
+
+
+async def analyze_upstream(prepared: Image.Image, key: str, dict_of_vars: dict, mode: str):
+    # If every analyzer declines (only possible without Groq in the chain), the route
+    # reports that no expression was detected.
+    try:
+        answers = await analyzer.analyze(prepared, dict_of_vars, mode) or []
+    except UpstreamBusy:
+        raise
+    except Exception as e:
+        logger.warning("Error calling Groq: %s", e)
+        ERRORS.inc(type=type(e).__name__)
+        return [{"expr": "Groq Error", "result": str(e), "assign": False}]
+
+    # Only remember real answers; an empty list means parsing failed and is worth retrying.
+    if result_cache is not None and answers:
+        await run_in_store_executor(result_cache, result_cache.set, key, answers)
+
+    return answers
+
+
+async def analyze_stream(img: Image, dict_of_vars: dict):
+    """
+    Streaming variant of `analyze`. Yields `(event, data)` tuples:
+
+    - `("progress", stage)` as the request moves through the pipeline,
+    - `("result", answer)` for each answer dict, as soon as it is complete.
+
+    Errors are raised to the caller, which has already started its response.
+    """
+    yield "progress", "preprocessing"
+    prepared, key, cached = await prepare_and_lookup(img, dict_of_vars)
+    if cached is not None:
+        yield "progress", "cached" if prepared is not None else "blank"
+        for answer in cached:
+            yield "result", answer
+        return
+
+    # The local analyzers answer at once, if they can; only the rest is streamed from Groq.
+    if analyzer.local:
+        answers = await analyzer.analyze(prepared, dict_of_vars, ANALYZE_MODE, remote=False)
+        if answers is not None or not analyzer.remote:
+            yield "progress", "local"
+            for answer in answers or []:
+                yield "result", answer
+            if result_cache is not None and answers:
+                await run_in_store_executor(result_cache, result_cache.set, key, answers)
+            return
+
+    image, model, template = await run_in_image_executor(encode_and_route, prepared)
+    yield "progress", "waiting_for_model"
+
+    parser = IncrementalDictParser()
+    answers = []
+    first_chunk = True
+    async for text in complete_stream(build_prompt(dict_of_vars, template), [image], 1024, model):
+        if first_chunk:
+            first_chunk = False
+            yield "progress", "model_responding"
+        for answer in parser.feed(text):
+            answer.setdefault("assign", False)
+            answers.append(answer)
+            yield "result", answer
+
+    # The model didn't produce anything the incremental parser recognised; give the
+    # full response to the regular, more forgiving parser.
+    if not answers:
+        answers = parse_response(parser.text)
+        for answer in answers:
+            yield "result", answer
+
+    if result_cache is not None and answers:
+        await run_in_store_executor(result_cache, result_cache.set, key, answers)
+
+
+def split_batch_response(answers: list, count: int):
+    """
+    Sorts the dicts of a multi-image answer back into one list per image. Returns
+    `(per_image, unmapped)`, where `unmapped` counts the dicts without a valid image number.
+    """
+    per_image = [[] for _ in range(count)]
+    unmapped = 0
     for answer in answers:
-        if 'assign' not in answer:
-            answer['assign'] = False
-            
-    return answers
\ No newline at end of file
+        try:
+            index = int(answer.pop("image")) - 1
+        except (KeyError, TypeError, ValueError):
+            index = -1
+        if 0 <= index < count:
+            per_image[index].append(answer)
+        else:
+            logger.info("Batch answer without a valid image number: %s", answer)
+            unmapped += 1
+    return per_image, unmapped
+
+
+async def analyze_single(image: tuple, dict_of_vars: dict) -> list:
+    response_text = await complete(build_prompt(dict_of_vars), [image], 1024, priority=PRIORITY_BATCH)
+    return parse_response(response_text)
+
+
+async def analyze_chunk(images: list, dict_of_vars: dict) -> list:
+    # A single image uses the regular prompt; several share one call and are told
+    # apart by the 'image' key the batch prompt asks for.
+    try:
+        if len(images) == 1:
+            return [await analyze_single(images[0], dict_of_vars)]
+        response_text = await complete(
+            build_batch_prompt(dict_of_vars, len(images)), images, min(1024 * len(images), 4096),
+            priority=PRIORITY_BATCH,
+        )
+        logger.debug("Model response: %s", response_text, extra=SAMPLED)
+        per_image, unmapped = split_batch_response(parse_response(response_text), len(images))
+        # Answers the model didn't number can't be told apart. Rather than reporting
+        # "No expression detected" for the images they belonged to, those images are
+        # asked about one at a time.
+        missing = [i for i, answers in enumerate(per_image) if not answers] if unmapped else []
+        if missing:
+            BATCH_FALLBACKS.inc(len(missing))
+            retried = await asyncio.gather(*(analyze_single(images[i], dict_of_vars) for i in missing))
+            for index, answers in zip(missing, retried):
+                per_image[index] = answers
+        return per_image
+    except UpstreamBusy:
+        raise
+    except Exception as e:
+        logger.warning("Error calling Groq: %s", e)
+        ERRORS.inc(type=type(e).__name__)
+        return [[{"expr": "Groq Error", "result": str(e), "assign": False}] for _ in images]
+
+
+async def analyze_batch(imgs: list, dict_of_vars: dict) -> list:
+    """
+    Solves several drawings with as few upstream calls as possible.
+
+    Cached drawings are answered directly, and then any the local analyzers can read.
+    The rest are packed `BATCH_IMAGES_PER_CALL` to a Groq request, and those requests run
+    concurrently (still bounded by `limiter`). Returns one list of answers per input
+    image, in order.
+    """
+    lookups = await asyncio.gather(*(prepare_and_lookup(img, dict_of_vars) for img in imgs))
+    results = [cached for _, _, cached in lookups]
+    pending = [i for i, (_, _, cached) in enumerate(lookups) if cached is None]
+
+    if pending and analyzer.local:
+        local = await asyncio.gather(
+            *(analyzer.analyze(lookups[i][0], dict_of_vars, ANALYZE_MODE, remote=False) for i in pending)
+        )
+        for index, answers in zip(pending, local):
+            if answers is not None or not analyzer.remote:
+                results[index] = answers or []
+                if result_cache is not None and answers:
+                    await run_in_store_executor(result_cache, result_cache.set, lookups[index][1], answers)
+        pending = [i for i in pending if results[i] is None]
+
+    if not pending:
+        return results
+
+    encoded = await asyncio.gather(
+        *(run_in_image_executor(encode_for_upstream, lookups[i][0]) for i in pending)
+    )
+    chunks = [pending[i:i + BATCH_IMAGES_PER_CALL] for i in range(0, len(pending), BATCH_IMAGES_PER_CALL)]
+    chunk_images = [encoded[i:i + BATCH_IMAGES_PER_CALL] for i in range(0, len(encoded), BATCH_IMAGES_PER_CALL)]
+    chunk_results = await asyncio.gather(
+        *(analyze_chunk(images, dict_of_vars) for images in chunk_images)
+    )
+
+    for indices, answers_per_image in zip(chunks, chunk_results):
+        for index, answers in zip(indices, answers_per_image):
+            for answer in answers:
+                answer.setdefault("assign", False)
+            results[index] = answers
+            key = lookups[index][1]
+            if result_cache is not None and answers and answers[0].get("expr") != "Groq Error":
+                await run_in_store_executor(result_cache, result_cache.set, key, answers)
+    return results
@@ -0,0 +1,123 @@
+# Measures how well and how fast `parse_answers` handles real model output.
+#
+# Usage (from the `server` directory):
+#     python bench/bench_parser.py [--iterations 2000] [--mutations 200] [--seed 0]
+#
+# Three parts:
+# 1. Corpus: every response in `parser_corpus.json` is parsed and the extracted 'expr'
+#    values are compared with the expected ones. Reports the success rate, how many
+#    responses needed repairs, and the mean parse time per response.
+# 2. Fuzz: each corpus response is randomly damaged (truncated, characters dropped or
+#    duplicated, quotes swapped, prose inserted). The parser must never raise; the report
+#    shows how often it still recovers at least one answer.
+# 3. Scaling: parse time for responses with 10 to 1000 dicts, to confirm the cost grows
+#    linearly with the response length.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from apps.calculator.parser import parse_answers  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_corpus.json")
+
+
+def time_per_call(func, arg, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations
+
+
+def mutate(text: str, rng: random.Random) -> str:
+    if not text:
+        return text
+    kind = rng.choice(("truncate", "drop", "duplicate", "swap_quotes", "prose", "strip_backslashes"))
+    i = rng.randrange(len(text))
+    if kind == "truncate":
+        return text[:i]
+    if kind == "drop":
+        return text[:i] + text[i + 1:]
+    if kind == "duplicate":
+        return text[:i] + text[i] + text[i:]
+    if kind == "swap_quotes":
+        return text.translate(str.maketrans({"'": '"', '"': "'"}))
+    if kind == "prose":
+        return "Here is the answer you asked for: " + text + " Hope this helps!"
+    return text.replace("\\\\", "\\")
+
+
+def run_corpus(corpus: list, iterations: int):
+    print("== Corpus")
+    passed = clean = 0
+    total_time = 0.0
+    for case in corpus:
+        result = parse_answers(case["text"])
+        got = [answer["expr"] for answer in result.answers]
+        ok = got == case["expect"]
+        passed += ok
+        clean += result.clean or (not case["expect"] and not got)
+        elapsed = time_per_call(parse_answers, case["text"], iterations)
+        total_time += elapsed
+        status = "ok  " if ok else "FAIL"
+        print(f"  {status} {case['name']:<28} {elapsed * 1e6:8.1f} us  repairs={len(result.diagnostics)}")
+        if not ok:
+            print(f"       expected {case['expect']!r}, got {got!r}")
+    print(f"  success {passed}/{len(corpus)}, needed no repairs {clean}/{len(corpus)}, "
+          f"mean {total_time / len(corpus) * 1e6:.1f} us per response")
+    return passed == len(corpus)
+
+
+def run_fuzz(corpus: list, mutations: int, seed: int):
+    print("== Fuzz")
+    rng = random.Random(seed)
+    attempts = recovered = crashed = 0
+    for case in corpus:
+        if not case["expect"]:
+            continue
+        for _ in range(mutations):
+            text = mutate(case["text"], rng)
+            attempts += 1
+            try:
+                recovered += parse_answers(text).ok
+            except Exception as e:  # The parser must never raise on model output.
+                crashed += 1
+                print(f"  CRASH on {text!r}: {e!r}")
+    print(f"  {attempts} damaged responses: recovered {recovered / attempts:.1%}, crashed {crashed}")
+    return crashed == 0
+
+
+def run_scaling(iterations: int):
+    print("== Scaling")
+    item = "{'expr': 'x_%d', 'result': '\\\\frac{%d}{2}', 'assign': True}"
+    for count in (10, 100, 1000):
+        text = "[" + ", ".join(item % (i, i) for i in range(count)) + "]"
+        elapsed = time_per_call(parse_answers, text, max(iterations // count, 3))
+        print(f"  {count:>5} dicts, {len(text) / 1024:7.1f} KiB: {elapsed * 1e3:8.2f} ms "
+              f"({elapsed / len(text) * 1e9:.0f} ns/char)")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--iterations", type=int, default=2000)
+    arg_parser.add_argument("--mutations", type=int, default=200)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    ok = run_corpus(corpus, args.iterations)
+    ok = run_fuzz(corpus, args.mutations, args.seed) and ok
+    run_scaling(args.iterations)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Micro-benchmarks for the image work done on every request before the upstream call.
+#
+# Usage (from the `server` directory):
+#     python bench/bench_preprocess.py [--iterations 20] [--canvas 1920x1080]
+#
+# Each stage is timed separately on a few typical canvases (blank, a small expression in
+# one part of the canvas, and a canvas full of strokes), so a regression in one step
+# isn't hidden by the others:
+# decode (base64 + PNG) -> prepare_image (crop, flatten, downscale) -> encode_prepared,
+# plus ink_regions as used by `/calculate/batch` with `split_regions`.
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+from apps.calculator.preprocess import encode_prepared, ink_regions, prepare_image  # noqa: E402
+from apps.calculator.utils import decode_data_url  # noqa: E402
+from constants import PREPROCESS_MAX_DIM, PREPROCESS_PADDING, REGION_CELL_SIZE  # noqa: E402
+from load import make_canvas  # noqa: E402
+
+
+def full_canvas(width: int, height: int, rng: random.Random) -> str:
+    # Strokes all over the canvas, so cropping can't shrink it.
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for _ in range(200):
+        points = [(rng.randrange(width), rng.randrange(height)) for _ in range(3)]
+        draw.line(points, fill=(255, 255, 255, 255), width=4)
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode("ascii")
+
+
+def time_per_call(func, iterations: int, *args) -> float:
+    func(*args)  # Warm up.
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(*args)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image preprocessing micro-benchmarks")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--canvas", default="1920x1080", help="Canvas size, WIDTHxHEIGHT")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.canvas.lower().split("x"))
+    rng = random.Random(args.seed)
+    cases = {
+        "blank": make_canvas(width, height, rng, blank=True),
+        "small expression": make_canvas(width, height, rng, blank=False),
+        "full canvas": full_canvas(width, height, rng),
+    }
+
+    print(f"{'canvas':<18} {'KiB':>6} {'decode':>10} {'prepare':>10} {'encode':>10} {'regions':>10}  upstream")
+    for name, data in cases.items():
+        img = decode_data_url(data)
+        decode = time_per_call(decode_data_url, args.iterations, data)
+        prepare = time_per_call(prepare_image, args.iterations, img, PREPROCESS_MAX_DIM, PREPROCESS_PADDING)
+        regions = time_per_call(ink_regions, args.iterations, img, REGION_CELL_SIZE)
+        prepared = prepare_image(img, PREPROCESS_MAX_DIM, PREPROCESS_PADDING)
+        if prepared is None:
+            encode, upstream = 0.0, "skipped (blank)"
+        else:
+            encode = time_per_call(encode_prepared, args.iterations, prepared)
+            mime, b64 = encode_prepared(prepared)
+            upstream = f"{prepared.mode} {prepared.width}x{prepared.height} {mime} {len(b64) / 1024:.0f} KiB"
+        print(f"{name:<18} {len(data) / 1024:6.0f} {decode * 1e3:8.2f}ms {prepare * 1e3:8.2f}ms "
+              f"{encode * 1e3:8.2f}ms {regions * 1e3:8.2f}ms  {upstream}")
+
+
+if __name__ == "__main__":
+    main()
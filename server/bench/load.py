@@ -0,0 +1,287 @@
+# Load driver for the calculate API.
+#
+# Usage (from the `server` directory):
+#     # Start a mock Groq and the server automatically, then run 500 requests, 50 at a time:
+#     python bench/load.py --spawn --requests 500 --concurrency 50
+#
+#     # Or drive an already running server (pass its pid to get CPU and memory numbers):
+#     python bench/load.py --url http://127.0.0.1:8000 --server-pid 12345
+#
+# Payloads look like what the React client sends: full-size transparent RGBA canvases,
+# encoded as PNG data URLs, with a few strokes somewhere on them. A share of them is
+# completely blank, and a share repeats earlier drawings (as when users press "Calculate"
+# again), so caching shows up in the numbers.
+#
+# `--format png` or `--format rle` sends the same drawings as raw bodies to
+# `/calculate/upload` instead, to compare against the JSON data-URL path.
+#
+# Reports latency percentiles (p50/p95/p99), throughput (requests per second), status
+# codes, and for the server process (and its workers) the CPU time per request and the
+# peak resident memory. CPU and memory are read from /proc, so they are Linux only.
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+import httpx
+from PIL import Image, ImageDraw
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+# --- Payloads ---
+
+def make_canvas(width: int, height: int, rng: random.Random, blank: bool) -> str:
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    if not blank:
+        draw = ImageDraw.Draw(img)
+        colors = [(255, 255, 255, 255), (238, 51, 51, 255), (34, 139, 230, 255)]
+        x0, y0 = rng.randrange(width // 2), rng.randrange(height // 2)
+        for _ in range(rng.randint(3, 12)):
+            points = [(x0 + rng.randrange(400), y0 + rng.randrange(200)) for _ in range(rng.randint(2, 6))]
+            draw.line(points, fill=rng.choice(colors), width=rng.randint(2, 6))
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffered.getvalue()).decode("ascii")
+
+
+def to_upload(payload: dict, body_format: str) -> dict:
+    # Turns a JSON payload into the raw body, content type and query of `/calculate/upload`.
+    from apps.calculator.upload import encode_rle
+    png = base64.b64decode(payload["data"].split(",", 1)[1])
+    if body_format == "rle":
+        body, content_type = encode_rle(Image.open(BytesIO(png))), "application/x-canvas-rle"
+    else:
+        body, content_type = png, "image/png"
+    return {
+        "content": body,
+        "headers": {"content-type": content_type},
+        "params": {"dict_of_vars": json.dumps(payload["dict_of_vars"])},
+    }
+
+
+def make_payloads(count: int, width: int, height: int, blank_share: float, repeat_share: float, seed: int) -> list:
+    rng = random.Random(seed)
+    unique = []
+    payloads = []
+    for _ in range(count):
+        if unique and rng.random() < repeat_share:
+            payloads.append(rng.choice(unique))
+            continue
+        data = make_canvas(width, height, rng, blank=rng.random() < blank_share)
+        payload = {"data": data, "dict_of_vars": {"x": "4"} if rng.random() < 0.3 else {}}
+        unique.append(payload)
+        payloads.append(payload)
+    return payloads
+
+
+# --- Process statistics (Linux /proc) ---
+
+def process_tree(pid: int) -> list:
+    # The server's own pid plus any worker processes it forked.
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+        except OSError:
+            continue
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pids: list) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except OSError:
+            continue
+    return total / CLOCK_TICKS
+
+
+def peak_rss_mb(pids: list) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+# --- Spawning the system under test ---
+
+def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn(args) -> list:
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(SERVER_DIR, "bench", "mock_groq.py"),
+        "--port", str(args.mock_port),
+        "--latency-median", str(args.latency_median),
+        "--latency-sigma", str(args.latency_sigma),
+        "--error-rate", str(args.error_rate),
+        "--rpm", str(args.rpm),
+        "--tpm", str(args.tpm),
+        "--seed", str(args.seed),
+    ], cwd=SERVER_DIR)
+    env = dict(os.environ)
+    env["GROQ_BASE_URL"] = f"http://127.0.0.1:{args.mock_port}"
+    env.setdefault("GEMINI_API_KEY", "mock-key")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=SERVER_DIR, env=env,
+    )
+    wait_until_up(f"http://127.0.0.1:{args.mock_port}/stats")
+    wait_until_up(f"http://127.0.0.1:{args.port}/")
+    args.url = f"http://127.0.0.1:{args.port}"
+    args.server_pid = server.pid
+    return [server, mock]
+
+
+# --- Load ---
+
+async def run_load(args, payloads: list):
+    latencies = []
+    statuses = {}
+    tokens = {"prompt": 0, "completion": 0, "requests": 0}
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+
+    async def worker(client: httpx.AsyncClient):
+        while True:
+            try:
+                payload = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                if args.format == "json":
+                    response = await client.post(args.endpoint, json=payload)
+                else:
+                    response = await client.post(args.endpoint, **payload)
+                status = response.status_code
+                # Only requests that reached Groq report their token usage.
+                if "x-prompt-tokens" in response.headers:
+                    tokens["requests"] += 1
+                    tokens["prompt"] += int(response.headers["x-prompt-tokens"])
+                    tokens["completion"] += int(response.headers["x-completion-tokens"])
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, statuses, tokens, elapsed
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for /calculate")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", default=None, help="Defaults to the endpoint for --format")
+    parser.add_argument("--format", choices=("json", "png", "rle"), default="json",
+                        help="json: data URLs to /calculate/; png, rle: raw bodies to /calculate/upload")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--canvas", default="1920x1080", help="Canvas size, WIDTHxHEIGHT")
+    parser.add_argument("--blank-share", type=float, default=0.1, help="Fraction of blank canvases")
+    parser.add_argument("--repeat-share", type=float, default=0.2, help="Fraction of repeated drawings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-pid", type=int, default=None, help="Server pid for CPU/memory stats")
+    parser.add_argument("--spawn", action="store_true", help="Start a mock Groq and the server")
+    parser.add_argument("--port", type=int, default=8765, help="Server port when spawning")
+    parser.add_argument("--mock-port", type=int, default=9765, help="Mock Groq port when spawning")
+    parser.add_argument("--latency-median", type=float, default=0.8)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=int, default=0, help="Mock Groq requests per minute; 0 for no limit")
+    parser.add_argument("--tpm", type=int, default=0, help="Mock Groq tokens per minute; 0 for no limit")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.canvas.lower().split("x"))
+    print(f"Generating {args.requests} payloads ({width}x{height})...")
+    payloads = make_payloads(args.requests, width, height, args.blank_share, args.repeat_share, args.seed)
+    if args.format == "json":
+        sizes = [len(p["data"]) for p in payloads]
+    else:
+        converted = {}
+        payloads = [converted.setdefault(id(p), to_upload(p, args.format)) for p in payloads]
+        sizes = [len(p["content"]) for p in payloads]
+    args.endpoint = args.endpoint or ("/calculate/" if args.format == "json" else "/calculate/upload")
+    print(f"Mean payload size: {sum(sizes) / len(sizes) / 1024:.0f} KiB")
+
+    processes = spawn(args) if args.spawn else []
+    try:
+        pids = process_tree(args.server_pid) if args.server_pid else []
+        cpu_before = cpu_seconds(pids)
+        latencies, statuses, tokens, elapsed = asyncio.run(run_load(args, payloads))
+        cpu_after = cpu_seconds(pids)
+        rss = peak_rss_mb(pids)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    latencies.sort()
+    print(f"Requests: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s), "
+          f"concurrency {args.concurrency}")
+    print("Status codes: " + ", ".join(f"{status}={count}" for status, count in sorted(statuses.items(), key=str)))
+    print("Latency: " + ", ".join(
+        f"p{p}={percentile(latencies, p) * 1000:.0f}ms" for p in (50, 95, 99)
+    ) + f", max={latencies[-1] * 1000:.0f}ms")
+    if tokens["requests"]:
+        print(f"Upstream tokens: {tokens['prompt'] / tokens['requests']:.0f} prompt, "
+              f"{tokens['completion'] / tokens['requests']:.0f} completion per request that called Groq "
+              f"({tokens['requests']} requests)")
+    if pids:
+        print(f"Server CPU: {(cpu_after - cpu_before) / len(latencies) * 1000:.2f}ms per request, "
+              f"peak RSS {rss:.0f} MiB ({len(pids)} processes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# A local stand-in for Groq's chat-completions API, for benchmarks and load tests.
+#
+# Usage (from the `server` directory):
+#     python bench/mock_groq.py --port 9000 --latency-median 0.8 --latency-sigma 0.5 --error-rate 0.02
+#
+# Then point the calculator server at it. The Groq SDK reads `GROQ_BASE_URL`:
+#     GROQ_BASE_URL=http://127.0.0.1:9000 uvicorn main:app
+#
+# Each request sleeps for a latency drawn from a log-normal distribution (so most calls
+# are near the median with a long tail, like the real service), then either fails with
+# a 429/500 at the configured rate or returns one of the canned responses from
+# `parser_corpus.json`. Streaming (`"stream": true`) is supported and sends the response
+# in small chunks spread over the same latency.
+#
+# With `--rpm` and/or `--tpm`, it also enforces a per-minute request/token limit the way
+# Groq does: every response reports the budget in `x-ratelimit-*` headers, and requests
+# over the limit get a 429 with `retry-after`.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+app = FastAPI()
+config = argparse.Namespace(
+    latency_median=0.8, latency_sigma=0.5, error_rate=0.0, rate_limit_share=0.5,
+    outputs=[], seed=None, stream_chunk=16, rpm=0, tpm=0,
+)
+stats = {"requests": 0, "errors": 0, "images": 0, "rate_limited": 0}
+buckets = {"updated": 0.0, "requests": 0.0, "tokens": 0.0}
+
+
+def load_outputs(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        corpus = json.load(f)
+    # Only responses that actually contain answers; the mock is meant to look healthy.
+    return [case["text"] for case in corpus if case.get("expect")]
+
+
+def draw_latency() -> float:
+    if config.latency_median <= 0:
+        return 0.0
+    return random.lognormvariate(0, config.latency_sigma) * config.latency_median
+
+
+def count_images(body: dict) -> int:
+    count = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            count += sum(1 for part in content if part.get("type") == "image_url")
+    return count
+
+
+def pick_output(images: int) -> str:
+    text = random.choice(config.outputs)
+    if images <= 1:
+        return text
+    # Batch requests expect every dict tagged with its image number.
+    items = ", ".join(f"{{'expr': 'item {i}', 'result': {i}, 'image': {i}}}" for i in range(1, images + 1))
+    return f"[{items}]"
+
+
+def error_response():
+    stats["errors"] += 1
+    if random.random() < config.rate_limit_share:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (mock)", "type": "tokens", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after": "1", "x-ratelimit-remaining-requests": "0"},
+        )
+    return JSONResponse({"error": {"message": "Internal server error (mock)", "type": "internal_server_error"}}, status_code=500)
+
+
+def take_rate_limit(tokens: int):
+    """
+    Counts a request against the per-minute limits. Returns `(allowed, headers)`.
+
+    Like Groq's, the limits are buckets that refill continuously, and the reset headers say
+    how long until a bucket is full again.
+    """
+    now = time.monotonic()
+    elapsed = now - buckets["updated"]
+    buckets["updated"] = now
+    buckets["requests"] = min(config.rpm, buckets["requests"] + elapsed * config.rpm / 60)
+    buckets["tokens"] = min(config.tpm, buckets["tokens"] + elapsed * config.tpm / 60)
+    allowed = (not config.rpm or buckets["requests"] >= 1) and (not config.tpm or buckets["tokens"] >= tokens)
+    if allowed:
+        buckets["requests"] -= 1
+        buckets["tokens"] -= tokens
+    headers = {}
+    wait = 0.0
+    if config.rpm:
+        headers.update({
+            "x-ratelimit-limit-requests": str(config.rpm),
+            "x-ratelimit-remaining-requests": str(int(buckets["requests"])),
+            "x-ratelimit-reset-requests": f"{(config.rpm - buckets['requests']) * 60 / config.rpm:.2f}s",
+        })
+        wait = max(wait, (1 - buckets["requests"]) * 60 / config.rpm)
+    if config.tpm:
+        headers.update({
+            "x-ratelimit-limit-tokens": str(config.tpm),
+            "x-ratelimit-remaining-tokens": str(int(buckets["tokens"])),
+            "x-ratelimit-reset-tokens": f"{(config.tpm - buckets['tokens']) * 60 / config.tpm:.2f}s",
+        })
+        wait = max(wait, (tokens - buckets["tokens"]) * 60 / config.tpm)
+    if not allowed:
+        headers["retry-after"] = str(max(int(wait + 0.999), 1))
+    return allowed, headers
+
+
+def usage_for(body: dict, text: str, images: int) -> dict:
+    # A rough token estimate: ~4 characters per token, plus a fixed cost per image.
+    prompt_chars = sum(
+        len(part.get("text", "")) if isinstance(part, dict) else 0
+        for message in body.get("messages", [])
+        for part in (message.get("content") if isinstance(message.get("content"), list) else [{"text": message.get("content", "")}])
+    )
+    prompt_tokens = prompt_chars // 4 + 1000 * images
+    completion_tokens = max(len(text) // 4, 1)
+    # Groq also reports how long reading the prompt took; assume ~20k prompt tokens a second.
+    return {
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens, "prompt_time": prompt_tokens / 20000,
+    }
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    images = count_images(body)
+    stats["images"] += images
+    latency = draw_latency()
+
+    if random.random() < config.error_rate:
+        await asyncio.sleep(latency / 4)
+        return error_response()
+
+    text = pick_output(images)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", "mock")
+    usage = usage_for(body, text, images)
+
+    allowed, headers = take_rate_limit(usage["total_tokens"])
+    if not allowed:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers=headers,
+        )
+
+    if not body.get("stream"):
+        await asyncio.sleep(latency)
+        return JSONResponse({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, headers=headers)
+
+    chunks = [text[i:i + config.stream_chunk] for i in range(0, len(text), config.stream_chunk)]
+
+    async def events():
+        # Time to first token is about a third of the latency; the rest is spread out.
+        await asyncio.sleep(latency / 3)
+        for i, piece in enumerate(chunks):
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            if i == len(chunks) - 1:
+                chunk["choices"][0]["finish_reason"] = "stop"
+                chunk["x_groq"] = {"id": completion_id, "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(latency * 2 / 3 / len(chunks))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+@app.get("/openai/v1/models")
+async def list_models():
+    # Used by the server to pre-warm its connections when it starts.
+    return {"object": "list", "data": [{"id": "meta-llama/llama-4-scout-17b-16e-instruct", "object": "model"}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Groq chat-completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-median", type=float, default=0.8, help="Median latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal sigma; 0 for a fixed latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--rate-limit-share", type=float, default=0.5, help="Fraction of failures that are 429s")
+    parser.add_argument("--outputs", default=os.path.join(BENCH_DIR, "parser_corpus.json"),
+                        help="JSON corpus of canned model responses")
+    parser.add_argument("--stream-chunk", type=int, default=16, help="Characters per streamed chunk")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests allowed per minute; 0 for no limit")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens allowed per minute; 0 for no limit")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    vars(config).update(vars(args))
+    buckets.update(updated=time.monotonic(), requests=args.rpm, tokens=args.tpm)
+    config.outputs = load_outputs(args.outputs)
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@
 # environment-specific settings (like database URLs or server ports) without
 # hard-coding them into your source code.
 from dotenv import load_dotenv
+import math
 import os
 
 # `load_dotenv()` reads the key-value pairs from your `.env` file and adds them
@@ -29,4 +30,224 @@ SERVER_URL = os.getenv("SERVER_URL")
 # The port number the server will run on.
 PORT = os.getenv("PORT")
 
-GROQ_API_KEY = os.getenv("GEMINI_API_KEY")
\ No newline at end of file
+
+def available_cpus() -> int:
+    """
+    The number of CPUs this process can actually use. `os.cpu_count()` counts every core
+    of the host, even inside a container that is limited to a few of them; this also
+    honors the CPU affinity mask and the cgroup's CPU quota (`docker run --cpus`).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 writes "<quota> <period>" (or "max <period>"); v1 uses two files and -1.
+    for quota_file, period_file in (
+        ("/sys/fs/cgroup/cpu.max", None),
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+    ):
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if period_file is not None:
+                with open(period_file) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], values[1]
+            if quota not in ("max", "-1"):
+                cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+            break
+        except (OSError, ValueError, IndexError):
+            continue
+    return cpus
+
+
+# Number of worker processes `python main.py` starts (ignored in "dev", which reloads a
+# single process). Each worker has its own event loop and image threads, so more workers
+# use more CPU cores, and each one takes roughly 90 MiB of memory even when idle. 0 means
+# one per available CPU (see `available_cpus`), up to MAX_AUTO_WORKERS; set a number to
+# go beyond that. When several workers run, caches and session state default to SQLite
+# files that all of them share.
+MAX_AUTO_WORKERS = 4
+WORKERS = int(os.getenv("WORKERS", "1")) or min(available_cpus(), MAX_AUTO_WORKERS)
+
+GROQ_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# --- Upstream Concurrency ---
+# How many Groq calls the server is allowed to have in flight at once, across all
+# workers. Requests beyond this limit wait in a queue instead of opening more connections.
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "16"))
+
+# Each worker gets an equal share of GROQ_MAX_CONCURRENCY, and keeps that many
+# connections to Groq open.
+GROQ_WORKER_CONCURRENCY = max(1, -(-GROQ_MAX_CONCURRENCY // WORKERS))
+
+# How many of those connections each worker opens when it starts, so the first requests
+# don't pay for DNS and TLS setup. 0 disables pre-warming.
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "4"))
+
+# How long (in seconds) an idle connection to Groq is kept open for reuse.
+UPSTREAM_KEEPALIVE = float(os.getenv("UPSTREAM_KEEPALIVE", "120"))
+
+# How many requests may wait for a free upstream slot before we start rejecting new
+# ones with a "503 Service Unavailable". This keeps a burst from piling up unbounded
+# work (and memory) on the worker.
+GROQ_MAX_QUEUE = int(os.getenv("GROQ_MAX_QUEUE", "256"))
+
+# Number of threads used for CPU-bound image work (base64 decode, PIL decode, JPEG
+# encode). Keeping this work off the event loop thread means one large canvas can't
+# stall every other request on the worker.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(8, available_cpus() + 2))))
+
+
+# --- Upstream Models ---
+# The vision model that reads and solves drawings.
+GROQ_MODEL = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+
+# The model used for drawings the local handwriting recognizer confidently reads as plain
+# written math ("12 + 7 =", "x = 4"; see LOCAL_MIN_CONFIDENCE), which don't need the
+# larger model's reasoning. Set it to a cheaper or faster vision model to use one; by
+# default it is the same as GROQ_MODEL.
+GROQ_SIMPLE_MODEL = os.getenv("GROQ_SIMPLE_MODEL", GROQ_MODEL)
+
+# A model to send requests to while the circuit breaker for the requested one is open
+# (see "Upstream Retries" below). Empty means no fallback: those requests get a 503.
+GROQ_FALLBACK_MODEL = os.getenv("GROQ_FALLBACK_MODEL", "")
+
+
+# --- Prompts ---
+# The most user-assigned variables included in a prompt. The client sends every variable
+# assigned so far; only the most recent ones are passed to the model, since each one
+# adds input tokens to every request.
+PROMPT_MAX_VARS = int(os.getenv("PROMPT_MAX_VARS", "32"))
+
+
+# --- Upstream Retries ---
+# How many times a failed Groq call is retried. Rate limits (429), timeouts, connection
+# errors and server errors (5xx) are retried; other errors are returned right away.
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+
+# Retries are limited to this fraction of all calls (plus a small reserve), so a Groq
+# outage can't multiply our traffic.
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+
+# The first retry waits up to RETRY_BASE_DELAY seconds, each later one up to twice as
+# long, capped at RETRY_MAX_DELAY. The actual wait is random within that range, so
+# requests that failed together don't all retry at the same moment.
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+
+# The longest a request waits (in seconds) for Groq's reported rate limits to allow
+# another call. If the budget frees up later than that, the request gets a 503.
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+
+# After this many consecutive failed calls to a model, it is considered down: for
+# BREAKER_COOLDOWN seconds its requests fail fast (or use GROQ_FALLBACK_MODEL), then a
+# single trial call decides whether it is back.
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "15"))
+
+
+# --- Result Cache ---
+# Where repeated analyses of the same drawing are remembered:
+# "memory" (per worker process, the default for one worker), "sqlite" (a file shared by
+# every worker on the machine, the default for several), or "off".
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "sqlite" if WORKERS > 1 else "memory")
+
+# Upper bound on the total size of cached answers. Least recently used entries are
+# evicted first once this budget is exceeded.
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# How long (in seconds) a cached answer stays valid.
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+
+# The SQLite file used when RESULT_CACHE_BACKEND is "sqlite".
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "result_cache.sqlite3")
+
+
+# --- Image Preprocessing ---
+# The drawing is cropped to its ink and then scaled down so that its longest side is at
+# most this many pixels before it is sent to the vision model.
+PREPROCESS_MAX_DIM = int(os.getenv("PREPROCESS_MAX_DIM", "1024"))
+
+# Empty margin (in pixels) kept around the ink when cropping.
+PREPROCESS_PADDING = int(os.getenv("PREPROCESS_PADDING", "16"))
+
+
+# --- Analysis Mode ---
+# "full": the vision model reads and solves the drawing in a single call (the default).
+# "transcribe": the model only transcribes the math, and the server's own solver computes
+# the answer. Word problems and drawings the solver can't handle fall back to "full".
+ANALYZE_MODE = os.getenv("ANALYZE_MODE", "full")
+
+# Which backend reads the drawings:
+# "groq": the vision model reads every drawing (the default).
+# "local": the server's own handwriting recognizer reads simple written math (digits,
+# + - x / =, parentheses and the variables x and y) on the CPU, without any network.
+# Drawings it can't read get "No expression detected".
+# "auto": the local recognizer answers what it reads confidently, and everything else
+# (word problems, diagrams, messy writing) still goes to the vision model.
+ANALYZER = os.getenv("ANALYZER", "groq")
+
+# How sure the local recognizer has to be of every symbol (0 to 1) before its reading
+# is used. Below this, "auto" sends the drawing to the vision model instead.
+LOCAL_MIN_CONFIDENCE = float(os.getenv("LOCAL_MIN_CONFIDENCE", "0.85"))
+
+
+# --- Batch Analysis ---
+# Groq's vision model accepts up to 5 images per request, so `/calculate/batch` packs
+# that many drawings into each upstream call.
+BATCH_IMAGES_PER_CALL = int(os.getenv("BATCH_IMAGES_PER_CALL", "5"))
+
+# The largest number of drawings (or canvas regions) accepted by one batch request.
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "50"))
+
+# When splitting a canvas into regions, strokes closer together than roughly this many
+# pixels are treated as part of the same drawing.
+REGION_CELL_SIZE = int(os.getenv("REGION_CELL_SIZE", "24"))
+
+
+# --- Logging ---
+# The minimum level of log messages to write: DEBUG, INFO, WARNING or ERROR.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# The fraction (0 to 1) of large, per-request debug messages (such as the full model
+# response) that is actually written. Only applies when LOG_LEVEL is DEBUG.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+
+# --- Metrics ---
+# With several workers, each one publishes its metrics to this SQLite file every
+# METRICS_PUBLISH_INTERVAL seconds, and `/metrics` reports the total over all of them,
+# whichever worker answers the scrape. Empty (the default for one worker) keeps the
+# metrics in memory only.
+METRICS_PATH = os.getenv("METRICS_PATH", "metrics.sqlite3" if WORKERS > 1 else "")
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+
+
+# --- Binary Uploads ---
+# The largest request body (in bytes) accepted by `/calculate/upload`. Uploads are cut off
+# as soon as they pass this size, without reading the rest.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(8 * 1024 * 1024)))
+
+
+# --- Stroke Input ---
+# The largest total number of points accepted by one `/calculate/strokes` request.
+STROKES_MAX_POINTS = int(os.getenv("STROKES_MAX_POINTS", "100000"))
+
+
+# --- Drawing Sessions ---
+# Requests with a `session_id` only send the parts of the canvas that changed since that
+# session's previous request. This is the memory budget (in bytes) for session state;
+# the least recently used sessions are forgotten first.
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# How long (in seconds) an idle session is remembered.
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+
+# Where session state is kept: "memory" or "sqlite", with the same defaults as the
+# result cache. A session's requests can land on any worker, so several workers need
+# the shared file.
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite" if WORKERS > 1 else "memory")
+
+# The SQLite file used when SESSION_BACKEND is "sqlite".
+SESSION_PATH = os.getenv("SESSION_PATH", "sessions.sqlite3")
@@ -0,0 +1,70 @@
+# This file sets up the server's logging.
+#
+# Two things matter for performance here:
+# 1. Writing to stdout is a blocking system call. Log records are therefore put on an
+#    in-memory queue by the request handlers, and a background thread (`QueueListener`)
+#    does the actual writing, so a slow terminal or log collector never stalls the event
+#    loop.
+# 2. Some messages (the full model response, the request's variables) are large and only
+#    useful for spot checks. They are logged with `extra=SAMPLED`, and only a fraction of
+#    them (`LOG_SAMPLE_RATE`) is kept.
+#
+# The HTTP client libraries under the Groq SDK log a line for every upstream call at
+# INFO level. Those would be a per-request write again, so they only log warnings.
+
+import logging
+import logging.handlers
+import queue
+import random
+
+# Pass as `extra=` to mark a log record as sampled.
+SAMPLED = {"sampled": True}
+
+# Loggers that are too chatty at INFO ("HTTP Request: POST .../chat/completions").
+QUIET_LOGGERS = ("httpx", "httpcore")
+
+_listener = None
+
+
+class SampleFilter(logging.Filter):
+    """Drops all but `rate` of the records marked as sampled; other records always pass."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+        return True
+
+
+def configure_logging(level: str, sample_rate: float):
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    # The filter runs on the caller's side of the queue, so dropped records cost almost nothing.
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(queue_handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+
+def stop_logging():
+    # Flushes the queue; called when the server shuts down.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
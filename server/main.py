@@ -36,12 +36,21 @@
 
 # Import necessary modules and classes from libraries.
 from contextlib import asynccontextmanager
+import logging
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn  # The server that runs our FastAPI application.
 from apps.calculator.route import router as calculator_router # Importing our calculator routes
-from constants import SERVER_URL, PORT, ENV # Importing configuration variables
-from apps.calculator.route import router as calculator_router
+from apps.calculator import lifecycle
+from constants import SERVER_URL, PORT, ENV, LOG_LEVEL, LOG_SAMPLE_RATE, WORKERS # Importing configuration variables
+from logging_config import configure_logging, stop_logging
+from metrics import TokenAccounting
+
+# Set up logging before anything else logs. Records are written by a background thread
+# so request handlers never block on stdout.
+configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
+logger = logging.getLogger(__name__)
 
 
 
@@ -55,10 +64,15 @@ from apps.calculator.route import router as calculator_router
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # --- Startup Logic Here ---
-    print("Server is starting up...")
+    # Every worker process runs this. It opens connections to Groq and loads the image
+    # codecs before the first request arrives (see `apps/calculator/lifecycle.py`).
+    logger.info("Server is starting up...")
+    await lifecycle.startup()
     yield # The application runs while the 'yield' is active.
     # --- Shutdown Logic Here ---
-    print("Server is shutting down...")
+    logger.info("Server is shutting down...")
+    await lifecycle.shutdown()
+    stop_logging()
 
 # This line creates the main FastAPI application instance.
 # The `app` object is the central point of your entire API. You will use it to
@@ -83,8 +97,14 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the frontend read the token counts added by `TokenAccounting` below.
+    expose_headers=["X-Prompt-Tokens", "X-Completion-Tokens"],
 )
 
+# This middleware counts the Groq tokens each request uses. It adds them to the response
+# as `X-Prompt-Tokens`/`X-Completion-Tokens` headers and to the `/metrics` histograms.
+app.add_middleware(TokenAccounting)
+
 
 # --- Path Operation Decorator ---
 # This is how you define an API endpoint.
@@ -98,6 +118,29 @@ async def root():
     # in FastAPI for non-blocking I/O operations, though not strictly required here.
     return {"message": "Server is running"}
 
+# --- Metrics ---
+# Prometheus (or any compatible scraper) reads this endpoint periodically. It reports
+# per-stage latency histograms, upstream token usage, cache and queue gauges, and error
+# counts. See `metrics.py` for the full list. With several workers, the numbers are the
+# totals over all of them, up to METRICS_PUBLISH_INTERVAL seconds old for the workers
+# other than the one answering.
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(await lifecycle.metrics_text(), media_type="text/plain; version=0.0.4")
+
+# --- Health Checks ---
+# `/healthz` (liveness) only says the process is up and answering. `/readyz` (readiness)
+# returns 503 until startup has finished, and while the worker's upstream queue is full;
+# its body shows how saturated the upstream connection slots are.
+@app.get('/healthz')
+async def healthz():
+    return {"status": "ok"}
+
+@app.get('/readyz')
+async def readyz():
+    ready, details = lifecycle.readiness()
+    return JSONResponse(details, status_code=200 if ready else 503)
+
 # --- Including a Router ---
 # As your application grows, you don't want to put all your routes in this one file.
 # FastAPI allows you to group related routes into an "APIRouter" in other files.
@@ -124,4 +167,7 @@ if __name__ == "__main__":
     # - `reload=(ENV == "dev")`: This is a developer's best friend. It tells uvicorn to
     #   watch for file changes and automatically restart the server when you save a file.
     #   This is only enabled if your ENV constant is set to "dev".
-    uvicorn.run("main:app", host=SERVER_URL, port=int(PORT), reload=(ENV == "dev"))
\ No newline at end of file
+    # - `workers`: Outside of development, uvicorn starts `WORKERS` processes that share
+    #   the port (reloading only works with a single process).
+    dev = ENV == "dev"
+    uvicorn.run("main:app", host=SERVER_URL, port=int(PORT), reload=dev, workers=None if dev else WORKERS)
\ No newline at end of file
@@ -0,0 +1,386 @@
+# This file collects the server's performance metrics and renders them for Prometheus.
+#
+# Three kinds of metrics are supported, mirroring Prometheus' own types:
+# - `Counter`: a number that only goes up (requests served, errors, tokens used).
+# - `Gauge`: a value that goes up and down (queue depth, cache size). Gauges can also be
+#   backed by a function that is called each time the metrics are scraped.
+# - `Histogram`: counts observations into buckets, used here for latencies.
+#
+# `span("stage")` times a block of code into the `calc_stage_seconds` histogram, which is
+# how each step of the request pipeline (decode, preprocess, upstream call, ...) is
+# measured. Everything is exposed in the Prometheus text format at `GET /metrics`.
+#
+# Token usage is counted per upstream call (by prompt template) and per HTTP request. The
+# `TokenAccounting` middleware gives each request its own tally, which `record_usage`
+# adds to, and reports it in `X-Prompt-Tokens`/`X-Completion-Tokens` response headers.
+#
+# Observations can come from the event loop and from the image thread pool at the same
+# time, so every update takes a lock.
+#
+# Every worker process has its own registry, but a scrape reaches whichever worker the
+# kernel hands the connection to. With several workers, each one therefore publishes a
+# `snapshot()` of its metrics to a SQLite file they all share (`SharedMetrics`), and
+# `/metrics` renders the sum over all of them. Gauges aren't summed: each worker's value
+# is shown with a `worker` label.
+
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond image work to multi-second model calls.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Token count buckets, from a short transcription to a batch of images.
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self, workers=None):
+        """
+        The metric in the text format. `workers` maps worker ids to their snapshots of
+        this metric; without it, only this process's values are shown.
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        if workers is None:
+            lines.extend(self._samples(self.snapshot(), self.label_names))
+        else:
+            lines.extend(self._merged_samples(workers))
+        return lines
+
+    def _merged_samples(self, workers):
+        # Counters and histograms add up across workers.
+        totals = {}
+        for items in workers.values():
+            for key, value in items:
+                key = tuple(key)
+                totals[key] = value if key not in totals else self._combine(totals[key], value)
+        return self._samples(sorted(totals.items()), self.label_names)
+
+    @staticmethod
+    def _combine(a, b):
+        return a + b
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self._values = {}
+        # For unlabelled counters kept elsewhere (e.g. cache hits), `function` is called
+        # on every scrape to read the current total.
+        self._function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        """The current values as a list of `(label values, value)` pairs."""
+        if self._function is not None:
+            return [((), self._function())]
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _samples(self, items, label_names):
+        return [f"{self.name}{_format_labels(label_names, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self._values = {}
+        # For unlabelled gauges, `function` is called on every scrape instead of storing a value.
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def snapshot(self):
+        """The current values as a list of `(label values, value)` pairs."""
+        if self._function is not None:
+            return [((), self._function())]
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _samples(self, items, label_names):
+        return [f"{self.name}{_format_labels(label_names, key)} {_format_value(v)}" for key, v in items]
+
+    def _merged_samples(self, workers):
+        # A sum of gauges is rarely meaningful (every worker reports the same shared cache
+        # size, for one), so each worker's value is labelled instead.
+        items = sorted(
+            (tuple(key) + (str(worker),), value)
+            for worker, values in workers.items() for key, value in values
+        )
+        return self._samples(items, self.label_names + ("worker",))
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        """The current values as a list of `(label values, [bucket counts..., sum, count])` pairs."""
+        with self._lock:
+            return sorted((key, list(state)) for key, state in self._values.items())
+
+    @staticmethod
+    def _combine(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def _samples(self, items, label_names):
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = (("le", _format_value(float(bound))),)
+                lines.append(f"{self.name}_bucket{_format_labels(label_names, key, le)} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(label_names, key, (('le', '+Inf'),))} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(label_names, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(label_names, key)} {state[-1]}")
+        return lines
+
+
+def snapshot() -> dict:
+    """Every metric of this process as plain, JSON-serializable data, keyed by name."""
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def render_metrics(workers=None) -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format. `workers`
+    maps worker ids to their `snapshot()`s (see `SharedMetrics.collect`); without it, only
+    this process's metrics are rendered.
+    """
+    lines = []
+    for metric in _registry:
+        if workers is None:
+            lines.extend(metric.render())
+        else:
+            lines.extend(metric.render({worker: values.get(metric.name, []) for worker, values in workers.items()}))
+    return "\n".join(lines) + "\n"
+
+
+class SharedMetrics:
+    """
+    The metrics of every worker process, in a SQLite file they all share.
+
+    Each worker `publish`es a snapshot of its own metrics now and then. `collect` returns
+    the latest snapshot of every worker started by the same parent process (the uvicorn
+    supervisor), with the calling worker's own taken fresh. Counters and histograms of a
+    worker that has exited are kept, so totals don't go backwards when it is replaced;
+    its gauges are dropped once its snapshot is `stale_after` seconds old.
+    """
+
+    def __init__(self, path: str, stale_after: float, busy_timeout: float = 0.5):
+        self.path = path
+        self.stale_after = stale_after
+        self.busy_timeout = busy_timeout
+        self.worker = os.getpid()
+        self.server = os.getppid()
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS worker_metrics ("
+            " worker INTEGER PRIMARY KEY,"
+            " server INTEGER NOT NULL,"
+            " updated REAL NOT NULL,"
+            " snapshot TEXT NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, as in the result cache's SQLite backend.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, conn: sqlite3.Connection, values: dict, now: float):
+        conn.execute(
+            "INSERT INTO worker_metrics (worker, server, updated, snapshot) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (worker) DO UPDATE SET"
+            " server = excluded.server, updated = excluded.updated, snapshot = excluded.snapshot",
+            (self.worker, self.server, now, json.dumps(values)),
+        )
+
+    def publish(self):
+        """Stores this worker's current metrics. Does file I/O; call it off the event loop."""
+        self._write(self._connect(), snapshot(), time.time())
+
+    def collect(self) -> dict:
+        """Returns `{worker id: snapshot}` for every worker of this server, for `render_metrics`."""
+        now = time.time()
+        own = snapshot()
+        conn = self._connect()
+        self._write(conn, own, now)
+        # Rows from an earlier run of the server (its workers had another parent) are
+        # removed once they have gone stale.
+        conn.execute(
+            "DELETE FROM worker_metrics WHERE server != ? AND updated < ?", (self.server, now - self.stale_after)
+        )
+        rows = conn.execute(
+            "SELECT worker, updated, snapshot FROM worker_metrics WHERE server = ?", (self.server,)
+        ).fetchall()
+        gauges = {metric.name for metric in _registry if metric.kind == "gauge"}
+        workers = {}
+        for worker, updated, data in rows:
+            values = own if worker == self.worker else json.loads(data)
+            if now - updated > self.stale_after:
+                values = {name: items for name, items in values.items() if name not in gauges}
+            workers[worker] = values
+        return workers
+
+
+# --- Calculator Metrics ---
+
+STAGE_SECONDS = Histogram(
+    "calc_stage_seconds", "Time spent in each stage of the calculate pipeline.", labels=("stage",)
+)
+REQUESTS = Counter(
+    "calc_requests_total", "Calculate requests handled, by endpoint.", labels=("endpoint",)
+)
+ERRORS = Counter(
+    "calc_errors_total", "Errors raised while handling requests, by exception type.", labels=("type",)
+)
+SESSION_REGIONS = Counter(
+    "calc_session_regions_total", "Canvas regions of session requests, by whether they were reused or solved.",
+    labels=("outcome",),
+)
+UPSTREAM_TOKENS = Counter(
+    "calc_upstream_tokens_total", "Tokens reported by the upstream API, by kind.", labels=("kind",)
+)
+CALL_TOKENS = Histogram(
+    "calc_upstream_call_tokens", "Tokens per upstream call, by kind and prompt template.",
+    labels=("kind", "prompt"), buckets=TOKEN_BUCKETS,
+)
+REQUEST_TOKENS = Histogram(
+    "calc_request_tokens", "Upstream tokens per HTTP request that called upstream, by kind.",
+    labels=("kind",), buckets=TOKEN_BUCKETS,
+)
+# Groq reports how long it spent reading the prompt; this is most of the time to first token.
+PROMPT_SECONDS = Histogram(
+    "calc_upstream_prompt_seconds", "Time the upstream model spent processing the prompt, by template.",
+    labels=("prompt",),
+)
+
+# The token tally of the request being handled, set by `TokenAccounting`.
+_request_tokens = contextvars.ContextVar("request_tokens", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Times the enclosed block into `calc_stage_seconds{stage=...}`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def record_usage(usage, prompt: str = ""):
+    # `usage` is the `usage` field of a chat completion; it may be missing. `prompt` is
+    # the name of the prompt template the call used.
+    if usage is None:
+        return
+    tally = _request_tokens.get()
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value:
+            short = kind.split("_")[0]
+            UPSTREAM_TOKENS.inc(value, kind=short)
+            CALL_TOKENS.observe(value, kind=short, prompt=prompt)
+            if tally is not None:
+                tally[short] += value
+    prompt_time = getattr(usage, "prompt_time", None)
+    if prompt_time:
+        PROMPT_SECONDS.observe(prompt_time, prompt=prompt)
+
+
+class TokenAccounting:
+    """
+    ASGI middleware that tallies the upstream tokens each request uses.
+
+    The tally is added as response headers when it is known before the response starts
+    (not for streamed responses, whose tokens arrive with the last chunk), and recorded in
+    `calc_request_tokens` once the response is complete.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        tally = {"prompt": 0, "completion": 0}
+        token = _request_tokens.set(tally)
+
+        async def send_with_tokens(message):
+            if message["type"] == "http.response.start" and (tally["prompt"] or tally["completion"]):
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-prompt-tokens", str(tally["prompt"]).encode("ascii")),
+                    (b"x-completion-tokens", str(tally["completion"]).encode("ascii")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_tokens)
+        finally:
+            _request_tokens.reset(token)
+            if tally["prompt"] or tally["completion"]:
+                for kind, value in tally.items():
+                    REQUEST_TOKENS.observe(value, kind=kind)
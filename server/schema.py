@@ -22,7 +22,8 @@
 # 4.  Automatic API Documentation: FastAPI uses these Pydantic models to generate the
 #     rich, interactive API documentation you see at `/docs`.
 
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field
 
 # --- Request Schemas ---
 # These models define the expected structure of data coming IN to your API.
@@ -41,6 +42,63 @@ class ImagePayload(BaseModel):
     # The `dict` type hint tells Pydantic to expect a JSON object (a dictionary).
     dict_of_vars: dict
 
+    # An id the client picks once per drawing session (e.g. a random UUID). When it is
+    # set, the server remembers which parts of the canvas it has already solved and only
+    # sends new or changed drawings to the model on the next request.
+    session_id: Optional[str] = Field(default=None, max_length=128)
+
+class ExpressionPayload(BaseModel):
+    """
+    This schema defines the payload for the `/calculate/expression` endpoint, which
+    solves an already-known expression on the server without calling the vision model.
+    """
+    # The math as plain text, e.g. "2 + 3 * 4", "x = 4" or "x + y = 10; x - y = 2".
+    # Several statements can be separated by newlines or semicolons. Anything longer than
+    # a few lines of math is rejected before it reaches the solver.
+    expression: str = Field(max_length=1000)
+
+    # Previously assigned variables, exactly like in `ImagePayload`.
+    dict_of_vars: dict = {}
+
+class BatchPayload(BaseModel):
+    """
+    This schema defines the payload for the `/calculate/batch` endpoint, which solves
+    several drawings at once (for example, every exercise on a worksheet).
+    """
+    # Each entry is a canvas image as a Base64 data URL, just like `ImagePayload.data`.
+    images: List[str]
+
+    # Previously assigned variables, shared by all of the images.
+    dict_of_vars: dict = {}
+
+    # If true, every image is split into its separate drawings (groups of strokes that
+    # are far apart from each other), and each drawing is solved on its own.
+    split_regions: bool = False
+
+class Stroke(BaseModel):
+    """
+    One continuous pen stroke, as drawn on the canvas.
+    """
+    # The points the pen passed through, flattened: [x0, y0, x1, y1, ...] in canvas pixels.
+    points: List[float]
+
+    # Any CSS color, e.g. "rgb(255, 255, 255)" or "#ee3333".
+    color: str = "rgb(255, 255, 255)"
+
+    # The line width in canvas pixels.
+    width: float = 5
+
+class StrokePayload(BaseModel):
+    """
+    This schema defines the payload for the `/calculate/strokes` endpoint. Instead of a
+    rendered image of the whole canvas, the client sends only the strokes it drew, which
+    the server draws at exactly the size the vision model needs.
+    """
+    strokes: List[Stroke]
+
+    # Previously assigned variables, exactly like in `ImagePayload`.
+    dict_of_vars: dict = {}
+
 class image_schema(BaseModel):
     img : str
     dict_of_vars : dict
\ No newline at end of file